@@ -28,14 +28,16 @@ from disnake.ext import tasks
 
 matplotlib.use('Agg')
 
+import asyncio
 import logging
 import time
 
 from redis.asyncio.client import Redis
 import disnake
-from asyncpg.exceptions import PostgresError, InterfaceError
+from asyncpg.exceptions import InterfaceError
 
 from bot.botbase import BotBase
+from bot.writebehind import MentionStatsAggregator
 from utils.init_tf import LoadedModel
 from utils.utilities import (random_color)
 
@@ -50,7 +52,6 @@ class NotABot(BotBase):
         self._poke_model = poke_model
         self.polls = {}
         self.timeouts = {}
-        self.temproles = {}
         self.banner_rotate = {}
         self.icon_rotate = {}
         self.gachilist = []
@@ -60,11 +61,21 @@ class NotABot(BotBase):
         self.redis: Optional[Redis] = None
         self.antispam = False
         self._ready_called = False
+        self.mention_stats = MentionStatsAggregator(self)
 
     async def async_init(self):
         await super().async_init()
+        self.mention_stats.start()
         #await self._server.create_server()
 
+    async def close(self):
+        try:
+            await self.mention_stats.close()
+        except Exception:
+            logger.exception('Failed to flush mention stats')
+
+        await super().close()
+
     @property
     def server(self):
         raise NotImplementedError("Server is not available")
@@ -92,50 +103,17 @@ class NotABot(BotBase):
         for guild in guilds:
             if guild.id in blacklisted:
                 await guild.leave()
-                continue
 
-            if guild.unavailable:
-                continue
-            if len(guild.roles) < 2:
-                continue
-
-            if not self._ready_called:
-                await self.dbutil.index_guild_roles(guild)
-                await self.dbutil.index_join_dates(guild)
+        guilds = [g for g in guilds if g.id not in blacklisted]
 
         logger.debug('Caching prefixes')
         if new_guilds:
             await self.dbutils.add_guilds(*new_guilds)
 
-        sql = 'SELECT guilds.*, prefixes.prefix FROM guilds LEFT OUTER JOIN prefixes ON guilds.guild=prefixes.guild'
-        rows = {}
-        for row in await self.dbutil.fetch(sql):
-            guild_id = row['guild']
-            if guild_id in rows:
-                prefix = row['prefix']
-                if prefix is not None:
-                    rows[guild_id]['prefixes'].add(prefix)
-
-            else:
-                d = {**row}
-                d.pop('guild', None)
-                d['prefixes'] = {d.get('prefix') or self.default_prefix}
-                d.pop('prefix', None)
-                rows[guild_id] = d
-
-        for guild_id, row in rows.items():
-            self.guild_cache.update_cached_guild(guild_id, **row)
+        await self.guild_cache.load()
 
         if not self._ready_called:
-            logger.info('Indexing user roles')
-            for guild in guilds:
-                if self.guild_cache.keeproles(guild.id):
-                    if guild.unavailable:
-                        continue
-
-                    success = await self.dbutil.index_guild_member_roles(guild)
-                    if not success:
-                        raise EnvironmentError('Failed to cache keeprole servers')
+            await self.index_guilds(guilds)
 
         # Always chunk my own server
         g = self.get_guild(217677285442977792)
@@ -145,6 +123,45 @@ class NotABot(BotBase):
         logger.info('Guilds cached')
         logger.info('Cached guilds in {} seconds'.format(round(time.time()-t, 2)))
 
+    async def index_guilds(self, guilds):
+        """
+        Index roles, join dates and keeproles of the given guilds.
+        Guilds are indexed concurrently with the amount of concurrent
+        guilds limited by config.index_concurrency.
+        Largest guilds are started first so they don't end up being the last ones running.
+        """
+        guilds = [g for g in guilds if not g.unavailable and len(g.roles) >= 2]
+        guilds.sort(key=lambda g: g.member_count or 0, reverse=True)
+
+        concurrency = self.config.index_concurrency or max(1, self.pool.get_max_size() // 2)
+        semaphore = asyncio.Semaphore(concurrency)
+        logger.info(f'Indexing {len(guilds)} guilds with concurrency of {concurrency}')
+        t = time.perf_counter()
+
+        async def index(guild):
+            async with semaphore:
+                t1 = time.perf_counter()
+                if self.guild_cache.keeproles(guild.id):
+                    # Also indexes guild roles
+                    success = await self.dbutil.index_guild_member_roles(guild)
+                    if not success:
+                        raise EnvironmentError('Failed to cache keeprole servers')
+                else:
+                    await self.dbutil.index_guild_roles(guild)
+
+                await self.dbutil.index_join_dates(guild)
+                logger.debug(f'Indexed guild {guild.id} with {guild.member_count} members in {time.perf_counter() - t1:.2f}s')
+
+        results = await asyncio.gather(*map(index, guilds), return_exceptions=True)
+        for guild, result in zip(guilds, results):
+            if isinstance(result, EnvironmentError):
+                raise result
+
+            if isinstance(result, Exception):
+                logger.error(f'Failed to index guild {guild.id}', exc_info=result)
+
+        logger.info(f'Indexed guilds in {time.perf_counter() - t:.2f}s')
+
     async def on_ready(self):
         logger.info(f'Logged in as {self.user.name}')
 
@@ -203,24 +220,9 @@ class NotABot(BotBase):
             await guild.leave()
             return
 
-        sql = 'INSERT INTO guilds (guild) VALUES (%s) ON CONFLICT (guild) DO NOTHING' % guild.id
-        try:
-            await self.dbutil.execute(sql)
-            await self.dbutil.execute('INSERT INTO prefixes (guild) VALUES (%s) ON CONFLICT DO NOTHING' % guild.id)
-        except PostgresError:
-            logger.exception('Failed to add new server')
-
-        sql = 'SELECT guilds.*, prefixes.prefix FROM guilds LEFT OUTER JOIN prefixes ON guilds.guild=prefixes.guild WHERE guilds.guild=%s' % guild.id
-        rows = await self.dbutil.fetch(sql)
-        if not rows:
-            return
+        await self.dbutil.add_guilds(guild.id)
 
-        prefixes = {r['prefix'] for r in rows if r['prefix'] is not None} or {self.default_prefix}
-        d = {**rows[0]}
-        d.pop('guild', None)
-        d.pop('prefix', None)
-        d['prefixes'] = prefixes
-        self.guild_cache.update_cached_guild(guild.id, **d)
+        await self.guild_cache.load((guild.id,))
 
     async def on_guild_role_delete(self, role):
         await self.dbutils.delete_role(role.id, role.guild.id)
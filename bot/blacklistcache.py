@@ -0,0 +1,157 @@
+from typing import Optional
+
+import disnake
+
+from bot.globals import BlacklistTypes, PermValues
+
+# Scope names used as keys. Matches the names in PermValues.VALUES
+USER = 'user'
+ROLE = 'role'
+CHANNEL = 'channel'
+GUILD = 'guild'
+
+
+def _perm_value(type_: int, scope: str) -> int:
+    if type_ == BlacklistTypes.WHITELIST:
+        v1 = PermValues.VALUES['whitelist']
+    else:
+        v1 = PermValues.VALUES['blacklist']
+
+    return v1 | PermValues.VALUES[scope]
+
+
+def _row_scope(uid, role, channel):
+    """Returns the scope and its id in the same priority order check_perms uses"""
+    if uid is not None:
+        return USER, uid
+    if role is not None:
+        return ROLE, role
+    if channel is not None:
+        return CHANNEL, channel
+
+    return GUILD, None
+
+
+class BlacklistCache:
+    """
+    In memory copy of the command_blacklist table.
+
+    Permissions of a guild are stored in a dict with the key
+    (command, scope, scope id) and the value being the same permission value
+    check_perms would calculate for that row. A command value of None
+    means the row applies to all commands.
+    Global blacklist entries are stored separately as
+    {command: set of user ids}
+    """
+    def __init__(self, bot):
+        self._bot = bot
+        self._guilds: dict[int, dict[tuple, int]] = {}
+        self._global: dict[Optional[str], set[Optional[int]]] = {}
+
+    @property
+    def bot(self):
+        return self._bot
+
+    async def load(self):
+        """Replaces the cached values with the values from the database"""
+        rows = await self.bot.dbutil.fetch('SELECT command, type, uid, role, channel, guild FROM command_blacklist')
+
+        guilds = {}
+        global_ = {}
+        for row in rows:
+            if row['type'] == BlacklistTypes.GLOBAL:
+                global_.setdefault(row['command'], set()).add(row['uid'])
+
+            if row['guild'] is None:
+                continue
+
+            scope, id_ = _row_scope(row['uid'], row['role'], row['channel'])
+            perms = guilds.setdefault(row['guild'], {})
+            key = (row['command'], scope, id_)
+            value = _perm_value(row['type'], scope)
+            perms[key] = min(value, perms.get(key, value))
+
+        self._guilds = guilds
+        self._global = global_
+
+    def set_perm(self, guild_id: int, command: Optional[str], type_: int,
+                 uid: int = None, role: int = None, channel: int = None):
+        """Add or change a permission. Called after the database has been updated"""
+        scope, id_ = _row_scope(uid, role, channel)
+        self._guilds.setdefault(guild_id, {})[(command, scope, id_)] = _perm_value(type_, scope)
+
+    def remove_perm(self, guild_id: int, command: Optional[str],
+                    uid: int = None, role: int = None, channel: int = None):
+        """Remove a permission. Called after the database row has been deleted"""
+        perms = self._guilds.get(guild_id)
+        if not perms:
+            return
+
+        perms.pop((command, *_row_scope(uid, role, channel)), None)
+        if not perms:
+            self._guilds.pop(guild_id, None)
+
+    def is_globally_blacklisted(self, command: str, user_id: int) -> bool:
+        for cmd in (command, None):
+            users = self._global.get(cmd)
+            if users and (user_id in users or None in users):
+                return True
+
+        return False
+
+    def get_perm(self, guild_id: int, command: str, user, channel_id: Optional[int],
+                 include_all_commands=True) -> Optional[int]:
+        """
+        Get the smallest permission value for the given command in the guild.
+        Works the same way as DatabaseUtils.check_blacklist with fetch_raw=True
+        except global blacklist isn't checked
+
+        Args:
+            guild_id: Id of the guild
+            command: Name of the command
+            user: user or member that is using the command
+            channel_id: Id of the channel the command is used in
+            include_all_commands: Whether to include perms that apply to all commands
+
+        Returns:
+            The permission value (see PermValues) or None if no permissions apply
+        """
+        perms = self._guilds.get(guild_id)
+        if not perms:
+            return None
+
+        if isinstance(user, disnake.Member):
+            role_ids = [r.id for r in user.roles]
+        else:
+            role_ids = ()
+
+        smallest = None
+        commands = (command, None) if include_all_commands else (command,)
+        get = perms.get
+        for cmd in commands:
+            values = [get((cmd, USER, user.id)), get((cmd, CHANNEL, channel_id)),
+                      get((cmd, GUILD, None))]
+            values.extend(get((cmd, ROLE, r)) for r in role_ids)
+
+            for v in values:
+                if v is not None and (smallest is None or v < smallest):
+                    smallest = v
+
+        return smallest
+
+    def check_blacklist(self, command: str, user, ctx, fetch_raw: bool = False):
+        """
+        In memory version of DatabaseUtils.check_blacklist.
+        Return values are the same as in that function
+        """
+        if self.is_globally_blacklisted(command, user.id):
+            return False
+
+        if ctx.guild is None:
+            return True
+
+        value = self.get_perm(ctx.guild.id, command, user, ctx.channel.id)
+        if value is None:
+            return None
+
+        return PermValues.RETURNS.get(value, False) if not fetch_raw else value
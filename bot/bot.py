@@ -35,7 +35,8 @@ from disnake.ext.commands import CheckFailure, CooldownMapping, CommandError
 from bot.commands import command, group, Command, Group
 from bot.cooldowns import monkey_patch
 from bot.formatter import HelpCommand
-from utils.utilities import seconds2str, call_later, check_blacklist
+from utils.timedset import TimedDict
+from utils.utilities import seconds2str, check_blacklist
 
 monkey_patch()
 
@@ -70,7 +71,8 @@ class Context(commands.Context):
     __slots__ = ('override_perms', 'skip_check', 'original_user',
                  'received_at')
 
-    undo_messages = {}
+    # Latest undoable message of each user
+    undo_messages = TimedDict(ttl=60, max_size=2000)
 
     def __init__(self, **attrs):
         super().__init__(**attrs)
@@ -83,12 +85,10 @@ class Context(commands.Context):
         self.command: Command = self.command
 
     async def undo(self):
-        old = self.undo_messages.pop(self.author.id, None)
-        if not old:
+        msg = self.undo_messages.pop(self.author.id, None)
+        if not msg:
             return False
 
-        msg, t = old
-        t.cancel()
         try:
             await msg.delete()
         except disnake.HTTPException:
@@ -98,14 +98,7 @@ class Context(commands.Context):
 
     def _add_undo(self, msg: disnake.Message):
         if msg:
-            old = self.undo_messages.pop(self.author.id, None)
-            if old:
-                old[1].cancel()
-
-            async def a():
-                self.undo_messages.pop(self.author.id, None)
-
-            self.undo_messages[self.author.id] = (msg, call_later(a, self.bot.loop, 60))
+            self.undo_messages[self.author.id] = msg
 
     async def send(self, content: Optional[str]=None, *, undoable=False, **kwargs) -> disnake.Message:
         kwargs.pop('ephemeral', None)
@@ -24,17 +24,22 @@ SOFTWARE.
 import logging
 import time
 from concurrent.futures import ThreadPoolExecutor
-from typing import Union
+from typing import Optional, Union
 
 import asyncpg
 import disnake
+from asyncpg.exceptions import PostgresError
 from disnake import ApplicationCommandInteraction
+from disnake.ext import tasks
 
 from bot import exceptions
+from bot.blacklistcache import BlacklistCache
 from bot.bot import Bot, Context
-from bot.dbutil import DatabaseUtils
+from bot.dbutil import DatabaseUtils, NamedStatementConnection
 from bot.globals import Auth
-from bot.guildcache import GuildCache
+from bot.guildcache import GuildCache, PrefixTrie
+from bot.writebehind import CommandUsageRecorder
+from utils.scheduler import Scheduler, get_scheduler
 
 logger = logging.getLogger('terminal')
 
@@ -45,16 +50,30 @@ class BotBase(Bot):
         super().__init__(self.get_command_prefix, conf, **options)
         self.default_prefix = prefix
         self._mention_prefix = ()
+        self._mention_trie = PrefixTrie()
         self.test_mode = test_mode
         if test_mode:
             self.loop.set_debug(True)
 
         self._guild_cache = GuildCache(self)
+        self._blacklist_cache = BlacklistCache(self)
         self._dbutil = DatabaseUtils(self)
+        self._pool = None
+        self._analytics_pool = None
+        self.command_recorder = CommandUsageRecorder(self)
+        # {name: async function} Awaited on close while the database pool is
+        # still open. Used by cogs to write data they have buffered
+        self._close_hooks = {}
         self.call_laters = {}
         self.threadpool = ThreadPoolExecutor(4)
         self.loop.set_default_executor(self.threadpool)
         self.do_not_track = set()
+        # Botbanned user ids. Kept in memory so on_message doesn't need a db
+        # round trip for every message. Updated by DatabaseUtils.botban and botunban
+        self.banned_users = set()
+        # Auth levels of bot staff {uid: auth_level}.
+        # Updated by DatabaseUtils.set_staff_auth
+        self.bot_staff = {}
 
         if cogs:
             self.default_cogs = set(cogs)
@@ -64,6 +83,40 @@ class BotBase(Bot):
     async def async_init(self):
         await self._setup_db()
         await self.dbutil.add_command('help')
+        self.banned_users = await self.dbutil.get_banned_users()
+        self.bot_staff = await self.dbutil.get_bot_staff()
+        await self.blacklist_cache.load()
+        # Other processes using the same db can modify the bans, staff and perms too
+        # so refresh them occasionally
+        self._refresh_db_caches.start()
+        self.command_recorder.start()
+        # Guild settings are cached so changes made by other processes are listened for
+        await self.guild_cache.start_listener()
+
+    def add_close_hook(self, name: str, func):
+        self._close_hooks[name] = func
+
+    def remove_close_hook(self, name: str):
+        self._close_hooks.pop(name, None)
+
+    async def close(self):
+        for name, func in list(self._close_hooks.items()):
+            try:
+                await func()
+            except Exception:
+                logger.exception(f'Failed to run close hook {name}')
+
+        try:
+            await self.command_recorder.close()
+        except Exception:
+            logger.exception('Failed to flush command usage')
+
+        try:
+            await self.guild_cache.close()
+        except Exception:
+            logger.exception('Failed to flush guild settings')
+
+        await super().close()
 
     def load_default_cogs(self):
         for cog in self.default_cogs:
@@ -77,16 +130,44 @@ class BotBase(Bot):
 
         return uid not in self.do_not_track
 
+    @staticmethod
+    def _server_settings(statement_timeout):
+        if statement_timeout is None:
+            return None
+
+        return {'statement_timeout': str(statement_timeout)}
+
+    def db_connect_args(self) -> dict:
+        """Arguments used to connect to the main database"""
+        return {'database': 'discord' if not self.test_mode else 'test',
+                'user': self.config.db_user,
+                'host': self.config.db_host,
+                'password': self.config.db_password}
+
     async def _setup_db(self):
-        db = 'discord' if not self.test_mode else 'test'
-        self._pool = await asyncpg.create_pool(database=db,
-                                               user=self.config.db_user,
-                                               host=self.config.db_host,
+        self._pool = await asyncpg.create_pool(**self.db_connect_args(),
                                                loop=self.loop,
-                                               password=self.config.db_password,
                                                max_inactive_connection_lifetime=600,
                                                min_size=10,
-                                               max_size=20)
+                                               max_size=20,
+                                               connection_class=NamedStatementConnection,
+                                               init=self.dbutil.statements.init_connection,
+                                               server_settings=self._server_settings(self.config.statement_timeout))
+
+        # Heavy read queries get their own pool so they can't starve the main pool
+        size = self.config.analytics_pool_size
+        if size and size > 0:
+            if self.config.analytics_dsn:
+                connect_args = {'dsn': self.config.analytics_dsn}
+            else:
+                connect_args = self.db_connect_args()
+
+            self._analytics_pool = await asyncpg.create_pool(**connect_args,
+                                                             loop=self.loop,
+                                                             max_inactive_connection_lifetime=600,
+                                                             min_size=1,
+                                                             max_size=size,
+                                                             server_settings=self._server_settings(self.config.analytics_statement_timeout))
 
     # The prefix function is defined to take bot as it's first parameter
     # no matter what so in order to not have the same object added in twice
@@ -95,19 +176,40 @@ class BotBase(Bot):
     def get_command_prefix(self, message):  # skipcq: PYL-W0211
         guild = message.guild
         if not guild:
-            prefixes = (*self._mention_prefix, self.default_prefix)
-        else:
-            prefixes = (*self.guild_cache.prefixes(guild.id), *self._mention_prefix)
-        return prefixes
+            return (*self._mention_prefix, self.default_prefix)
+
+        # Return only the prefix the message starts with so it isn't
+        # compared against every prefix of the guild
+        content = message.content
+        prefix = self.guild_cache.prefix_trie(guild.id).match(content) or self._mention_trie.match(content)
+        if prefix:
+            return prefix
+
+        # Nothing matched. An empty list isn't allowed so return the
+        # mention prefixes which are valid everywhere and won't match either
+        return self._mention_prefix or self.guild_cache.prefixes(guild.id)
 
     @property
     def pool(self) -> asyncpg.Pool:
         return self._pool
 
+    @property
+    def analytics_pool(self) -> Optional[asyncpg.Pool]:
+        return self._analytics_pool
+
     @property
     def guild_cache(self):
         return self._guild_cache
 
+    @property
+    def scheduler(self) -> Scheduler:
+        """Scheduler shared by everything that needs to run something later"""
+        return get_scheduler(self.loop)
+
+    @property
+    def blacklist_cache(self) -> BlacklistCache:
+        return self._blacklist_cache
+
     @property
     def dbutil(self) -> DatabaseUtils:
         return self._dbutil
@@ -118,6 +220,7 @@ class BotBase(Bot):
 
     async def on_ready(self):
         self._mention_prefix = (self.user.mention, f'<@!{self.user.id}>')
+        self._mention_trie = PrefixTrie(self._mention_prefix)
         logger.info(f'Logged in as {self.user.name}')
         logger.debug('READY')
 
@@ -136,24 +239,33 @@ class BotBase(Bot):
             return
 
         # Ignore if user is botbanned
-        if message.author.id != self.owner_id and (await self.dbutil.fetch('SELECT 1 FROM banned_users WHERE uid=%s' % message.author.id, fetchmany=False)):
+        if message.author.id != self.owner_id and message.author.id in self.banned_users:
             return
 
         await self.process_commands(message, local_time=local)
 
+    @tasks.loop(minutes=10)
+    async def _refresh_db_caches(self):
+        try:
+            self.banned_users = await self.dbutil.get_banned_users()
+        except PostgresError:
+            logger.exception('Failed to refresh banned users')
+
+        try:
+            self.bot_staff = await self.dbutil.get_bot_staff()
+        except PostgresError:
+            logger.exception('Failed to refresh bot staff')
+
+        try:
+            await self.blacklist_cache.load()
+        except PostgresError:
+            logger.exception('Failed to refresh command blacklist')
+
     async def _check_auth(self, user_id, auth_level):
         if auth_level == 0:
             return True
 
-        sql = 'SELECT auth_level FROM bot_staff WHERE uid=%s' % user_id
-        rows = await self.dbutil.fetch(sql, fetchmany=False)
-        if not rows:
-            return False
-
-        if rows['auth_level'] >= auth_level:
-            return True
-        else:
-            return False
+        return self.bot_staff.get(user_id, 0) >= auth_level
 
     async def check_auth(self, ctx: Context | ApplicationCommandInteraction):
         if isinstance(ctx, ApplicationCommandInteraction):
@@ -85,6 +85,16 @@ class Config:
         self.redis_host = get_config_value(self.config, 'Database', 'RedisHost', str) or self.db_host
         self.redis_auth = get_config_value(self.config, 'Database', 'RedisAuth', str, None)
         self.redis_port = get_config_value(self.config, 'Database', 'RedisPort', int)
+        # How many guilds are indexed concurrently on startup. Defaults to half of the db pool size
+        self.index_concurrency = get_config_value(self.config, 'Database', 'IndexConcurrency', int, None)
+        # Queries slower than this in milliseconds are logged
+        self.slow_query_threshold = get_config_value(self.config, 'Database', 'SlowQueryThreshold', int, None)
+        # Separate pool for heavy read queries. Uses the main database if no dsn is given
+        self.analytics_dsn = get_config_value(self.config, 'Database', 'AnalyticsDSN', None, None)
+        self.analytics_pool_size = get_config_value(self.config, 'Database', 'AnalyticsPoolSize', int, 3)
+        # Statement timeouts in milliseconds
+        self.statement_timeout = get_config_value(self.config, 'Database', 'StatementTimeout', int, None)
+        self.analytics_statement_timeout = get_config_value(self.config, 'Database', 'AnalyticsStatementTimeout', int, 30000)
 
         try:
             self.owner = self.config.getint('Owner', 'OwnerID', fallback=None)
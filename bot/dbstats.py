@@ -0,0 +1,125 @@
+import logging
+import re
+import time
+from bisect import bisect_left
+from collections import deque
+from functools import lru_cache
+
+logger = logging.getLogger('terminal')
+
+# Upper bounds of the latency histogram buckets in milliseconds.
+# Last bucket is for everything above the largest bound
+BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+
+_number_regex = re.compile(r'(?<![$\w])\d+\b')
+_whitespace_regex = re.compile(r'\s+')
+
+
+@lru_cache(maxsize=2048)
+def query_name(sql: str, max_len=100) -> str:
+    """
+    Creates a name for a raw sql query. Number literals are replaced with ?
+    so queries that have ids formatted into them are grouped together
+    """
+    sql = _number_regex.sub('?', sql)
+    sql = _whitespace_regex.sub(' ', sql).strip()
+    if len(sql) > max_len:
+        sql = sql[:max_len - 3] + '...'
+
+    return sql
+
+
+class QueryStat:
+    __slots__ = ('count', 'total_time', 'max_time', 'buckets', 'rows',
+                 'acquires', 'acquire_time', 'max_acquire_time', 'errors')
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0.0
+        self.max_time = 0.0
+        self.buckets = [0] * (len(BUCKETS) + 1)
+        self.rows = 0
+        self.acquires = 0
+        self.acquire_time = 0.0
+        self.max_acquire_time = 0.0
+        self.errors = 0
+
+    def percentile(self, p: float) -> float:
+        """
+        Estimate of the percentile in milliseconds. Returns the upper bound of the bucket
+        the percentile falls in
+        """
+        if not self.count:
+            return 0
+
+        target = self.count * p
+        seen = 0
+        for idx, amount in enumerate(self.buckets):
+            seen += amount
+            if seen >= target:
+                if idx < len(BUCKETS):
+                    return BUCKETS[idx]
+                break
+
+        return self.max_time * 1000
+
+
+class QueryStats:
+    """
+    Collects execution time, row count and pool acquire wait time per query.
+    Queries slower than slow_threshold seconds are logged and kept in slow_queries
+    """
+    def __init__(self, slow_threshold: float = 0.5, slow_log_size: int = 50):
+        self.slow_threshold = slow_threshold
+        self.stats: dict[str, QueryStat] = {}
+        self.slow_queries: deque[tuple[float, str, float, int]] = deque(maxlen=slow_log_size)
+        self.started_at = time.time()
+
+    def _get(self, name) -> QueryStat:
+        stat = self.stats.get(name)
+        if stat is None:
+            stat = QueryStat()
+            self.stats[name] = stat
+
+        return stat
+
+    def record_acquire(self, name: str, wait: float):
+        stat = self._get(name)
+        stat.acquires += 1
+        stat.acquire_time += wait
+        if wait > stat.max_acquire_time:
+            stat.max_acquire_time = wait
+
+    def record(self, name: str, elapsed: float, rows: int = 0, error=False):
+        stat = self._get(name)
+        stat.count += 1
+        stat.total_time += elapsed
+        stat.rows += rows
+        if error:
+            stat.errors += 1
+
+        if elapsed > stat.max_time:
+            stat.max_time = elapsed
+
+        stat.buckets[bisect_left(BUCKETS, elapsed * 1000)] += 1
+
+        if elapsed >= self.slow_threshold:
+            self.slow_queries.append((time.time(), name, elapsed, rows))
+            logger.warning(f'Slow query took {elapsed*1000:.0f}ms with {rows} rows: {name}')
+
+    def reset(self):
+        self.stats.clear()
+        self.slow_queries.clear()
+        self.started_at = time.time()
+
+    def top(self, key='total', limit=10) -> list[tuple[str, QueryStat]]:
+        keys = {
+            'total': lambda s: s.total_time,
+            'count': lambda s: s.count,
+            'max': lambda s: s.max_time,
+            'avg': lambda s: s.total_time / s.count if s.count else 0,
+            'acquire': lambda s: s.acquire_time,
+            'rows': lambda s: s.rows
+        }
+        f = keys.get(key, keys['total'])
+        return sorted(self.stats.items(), key=lambda kv: f(kv[1]), reverse=True)[:limit]
@@ -1,43 +1,117 @@
+import hashlib
 import logging
 import re
 import time
-import types
 import typing
+from array import array
+from contextlib import asynccontextmanager
 from datetime import datetime
 
+import asyncpg
 import disnake
-from asyncpg.exceptions import PostgresError
+from asyncpg.exceptions import PostgresError, InvalidCachedStatementError
 
+from bot.dbstats import QueryStats, query_name
 from bot.globals import BlacklistTypes
 from utils.utilities import check_perms
 
 logger = logging.getLogger('terminal')
 
+# Channel used to notify other processes of changes to the guilds and prefixes tables
+GUILD_SETTINGS_CHANNEL = 'guild_settings'
+
 if typing.TYPE_CHECKING:
     from bot.botbase import BotBase
 
 
-def _args_to_string(args):
+# Frequently used queries that are prepared on every pooled connection
+# when it's created. Use them with the *_named methods of DatabaseUtils
+HOT_STATEMENTS = {
+    'add_command_stats': 'INSERT INTO command_stats AS cs (parent, cmd, uses) '
+                         'SELECT * FROM unnest($1::varchar[], $2::varchar[], $3::bigint[]) '
+                         'ON CONFLICT (parent, cmd) DO UPDATE SET uses=cs.uses + EXCLUDED.uses',
+    'add_mention_stats': 'INSERT INTO mention_stats AS ms (guild, role, amount, role_name) '
+                         'SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::varchar[]) '
+                         'ON CONFLICT (guild, role) DO UPDATE SET amount=ms.amount + EXCLUDED.amount, role_name=EXCLUDED.role_name',
+    'multiple_last_seen': 'INSERT INTO last_seen_users (uid, username, guild, last_seen) '
+                          'SELECT * FROM unnest($1::bigint[], $2::varchar[], $3::bigint[], $4::timestamptz[]) '
+                          'ON CONFLICT (uid, guild) DO UPDATE SET last_seen=EXCLUDED.last_seen, username=EXCLUDED.username',
+    'add_r9k_digests': 'INSERT INTO r9k_digests (digest) SELECT unnest($1::bytea[]) ON CONFLICT DO NOTHING',
+    'get_user_keeproles': 'SELECT role FROM userroles ur INNER JOIN roles r ON r.id = ur.role '
+                          'WHERE r.guild=$1 AND ur.uid=$2',
+    'get_join_date': 'SELECT first_join FROM join_dates WHERE uid=$1 AND guild=$2',
+    'get_timezone': 'SELECT timezone FROM users WHERE id=$1',
+}
+
+
+class Workload:
+    """
+    Decides which pool a query is run on. Analytics queries are run on
+    a separate pool if one has been configured
     """
-    DO NOT USE WITH STRINGS
-    ARGS ARE NOT ESCAPED
+    DEFAULT = 'default'
+    ANALYTICS = 'analytics'
+
 
-    Will turn args to a string. Should be only used on non string args only
-    Args:
-        args: List or generator of arguments
+class NamedStatementConnection(asyncpg.Connection):
+    """Connection class that holds the statements prepared by StatementRegistry"""
+    __slots__ = ('named_statements',)
 
-    Returns:
-        String of args in format (1,2),(3,4),(5,6),...
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.named_statements = {}
+
+
+class StatementRegistry:
+    """
+    Registry of named sql statements that are prepared once per connection.
+    Connections must be instances of NamedStatementConnection
     """
-    if isinstance(args, types.GeneratorType) or isinstance(args[0], list) or isinstance(args[0], tuple):
-        return ','.join(f"({','.join(map(str, arg))})" for arg in args)
-    else:
-        return ','.join(f"({arg})" for arg in args)
+    def __init__(self, statements=None):
+        self._statements: dict[str, str] = dict(statements or {})
+        self.hits = 0
+        self.misses = 0
+        # Statements that have failed to prepare. Used to log the failure only once
+        self._failed: set[str] = set()
+
+    def register(self, name: str, sql: str):
+        self._statements[name] = sql
+
+    async def init_connection(self, conn: NamedStatementConnection):
+        """
+        Used as the init hook of the pool. Statements that fail to prepare,
+        e.g. because a migration hasn't been applied yet, are skipped
+        so they don't prevent connecting. They are prepared again when used
+        """
+        for name, sql in self._statements.items():
+            try:
+                conn.named_statements[name] = await conn.prepare(sql)
+            except PostgresError as e:
+                if name not in self._failed:
+                    self._failed.add(name)
+                    logger.warning(f'Failed to prepare statement {name}: {e}')
+
+    async def get(self, conn, name: str, reprepare=False) -> 'asyncpg.prepared_stmt.PreparedStatement':
+        stmt = conn.named_statements.get(name)
+        if stmt is not None and not reprepare:
+            self.hits += 1
+            return stmt
+
+        self.misses += 1
+        stmt = await conn.prepare(self._statements[name])
+        conn.named_statements[name] = stmt
+        return stmt
+
+    def stats(self) -> dict[str, int]:
+        return {'statements': len(self._statements), 'hits': self.hits, 'misses': self.misses}
 
 
 class DatabaseUtils:
     def __init__(self, bot):
         self._bot = bot
+        self.statements = StatementRegistry(HOT_STATEMENTS)
+        threshold = getattr(getattr(bot, 'config', None), 'slow_query_threshold', None)
+        self.query_stats = QueryStats() if threshold is None else QueryStats(slow_threshold=threshold / 1000)
 
     @property
     def bot(self) -> 'BotBase':
@@ -65,23 +139,59 @@ class DatabaseUtils:
 
         return int(m.groups()[0])
 
-    async def fetchval(self, sql, args=None):
+    def pool_for(self, workload: str = Workload.DEFAULT) -> asyncpg.Pool:
+        if workload == Workload.ANALYTICS:
+            return self.bot.analytics_pool or self.bot.pool
+
+        return self.bot.pool
+
+    @asynccontextmanager
+    async def acquire(self, name: str, workload: str = Workload.DEFAULT):
+        """Acquire a connection from the pool and record how long it took"""
+        t = time.perf_counter()
+        async with self.pool_for(workload).acquire() as conn:
+            self.query_stats.record_acquire(name, time.perf_counter() - t)
+            yield conn
+
+    async def _run(self, name, func, *args, count_rows=None, **kwargs):
+        """Run a query function and record its execution time and row count"""
+        t = time.perf_counter()
+        try:
+            res = await func(*args, **kwargs)
+        except Exception:
+            self.query_stats.record(name, time.perf_counter() - t, error=True)
+            raise
+
+        rows = count_rows(res) if count_rows else 0
+        self.query_stats.record(name, time.perf_counter() - t, rows)
+        return res
+
+    def _status_rows(self, status) -> int:
+        if not isinstance(status, str):
+            return 0
+        return self.parse_affected_rows(status)
+
+    async def fetchval(self, sql, args=None, workload: str = Workload.DEFAULT):
         args = args or ()
+        name = query_name(sql)
 
-        async with self.bot.pool.acquire() as conn:
-            async with conn.transaction():
-                return await conn.fetchval(sql, *args)
+        async with self.acquire(name, workload) as conn:
+            return await self._run(name, conn.fetchval, sql, *args,
+                                   count_rows=lambda r: int(r is not None))
 
-    async def fetch(self, sql, args=None, timeout=None, measure_time=False, fetchmany=True):
+    async def fetch(self, sql, args=None, timeout=None, measure_time=False, fetchmany=True,
+                    workload: str = Workload.DEFAULT):
         args = args or ()
+        name = query_name(sql)
 
-        async with self.bot.pool.acquire() as conn:
+        async with self.acquire(name, workload) as conn:
             t = time.perf_counter()
 
             if fetchmany:
-                row = await conn.fetch(sql, *args, timeout=timeout)
+                row = await self._run(name, conn.fetch, sql, *args, timeout=timeout, count_rows=len)
             else:
-                row = await conn.fetchrow(sql, *args, timeout=timeout)
+                row = await self._run(name, conn.fetchrow, sql, *args, timeout=timeout,
+                                      count_rows=lambda r: int(r is not None))
 
             if measure_time:
                 return row, time.perf_counter() - t
@@ -103,11 +213,14 @@ class DatabaseUtils:
         Returns:
             Status from Connection.copy_records_to_table
         """
-        async with self.bot.pool.acquire() as conn:
+        name = f'COPY {table}'
+        async with self.acquire(name) as conn:
             async with conn.transaction():
                 try:
                     t = time.perf_counter()
-                    row = await conn.copy_records_to_table(table, records=records, columns=columns, timeout=timeout)
+                    row = await self._run(name, conn.copy_records_to_table, table,
+                                          records=records, columns=columns, timeout=timeout,
+                                          count_rows=self._status_rows)
 
                     if measure_time:
                         return row, time.perf_counter() - t
@@ -133,17 +246,19 @@ class DatabaseUtils:
         """
         args = args or [() for _ in sql_statements]
 
-        async with self.bot.pool.acquire() as conn:
+        async with self.acquire('execute_chunked') as conn:
             async with conn.transaction():
                 try:
                     t = time.perf_counter()
                     rows = []
 
                     for idx, sql in enumerate(sql_statements):
+                        name = query_name(sql)
                         if insertmany:
-                            row = await conn.executemany(sql, args[idx], timeout=timeout)
+                            row = await self._run(name, conn.executemany, sql, args[idx], timeout=timeout)
                         else:
-                            row = await conn.execute(sql, *args[idx], timeout=timeout)
+                            row = await self._run(name, conn.execute, sql, *args[idx], timeout=timeout,
+                                                  count_rows=self._status_rows)
 
                         rows.append(rows)
 
@@ -169,36 +284,129 @@ class DatabaseUtils:
         """
 
         args = args or ()
+        name = query_name(sql)
+
+        # Single statements and executemany are atomic so no explicit transaction is needed
+        async with self.acquire(name) as conn:
+            t = time.perf_counter()
+            if insertmany:
+                row = await self._run(name, conn.executemany, sql, args, timeout=timeout)
+            else:
+                row = await self._run(name, conn.execute, sql, *args, timeout=timeout,
+                                      count_rows=self._status_rows)
+
+            if measure_time:
+                return row, time.perf_counter() - t
+
+        return row
 
-        async with self.bot.pool.acquire() as conn:
+    async def execute_unnest(self, sql, arrays, chunk_size=None, timeout=None, conn=None):
+        """
+        Run a statement that takes its values as arrays e.g.
+        INSERT INTO t (a, b) SELECT * FROM unnest($1::bigint[], $2::bigint[])
+        The sql text stays the same no matter how many rows are given
+        so postgres can reuse the plan.
+
+        Args:
+            sql: The statement. Array params must come first
+            arrays: List of arrays of equal length followed by scalar params
+                    that are given to every chunk as is
+            chunk_size: If given, the arrays are split into chunks of this size
+                        and every chunk is run in the same transaction
+            timeout: Optional timeout for each statement
+            conn: Optional connection to use. Otherwise one is acquired from the pool
+
+        Returns:
+            Amount of affected rows
+        """
+        arrays = list(arrays)
+        array_count = 0
+        for a in arrays:
+            if not isinstance(a, (list, tuple)):
+                break
+            array_count += 1
+
+        length = len(arrays[0]) if array_count else 0
+        chunk_size = chunk_size or max(length, 1)
+
+        name = query_name(sql)
+
+        async def run(c):
+            affected = 0
+            for i in range(0, length, chunk_size):
+                args = [a[i:i+chunk_size] for a in arrays[:array_count]]
+                args.extend(arrays[array_count:])
+                res = await self._run(name, c.execute, sql, *args, timeout=timeout,
+                                      count_rows=self._status_rows)
+                affected += self.parse_affected_rows(res)
+            return affected
+
+        if conn is not None:
+            return await run(conn)
+
+        async with self.acquire(name) as conn:
             async with conn.transaction():
-                try:
-                    t = time.perf_counter()
-                    if insertmany:
-                        row = await conn.executemany(sql, args, timeout=timeout)
-                    else:
-                        row = await conn.execute(sql, *args, timeout=timeout)
+                return await run(conn)
 
-                    if measure_time:
-                        return row, time.perf_counter() - t
+    async def _run_named(self, conn, name, method, args, timeout=None):
+        if method == 'fetch':
+            count_rows = len
+        else:
+            count_rows = lambda r: int(r is not None)  # skipcq: PYL-E731
 
-                except PostgresError as e:
-                    raise e
+        stmt = await self.statements.get(conn, name)
+        try:
+            return await self._run(name, getattr(stmt, method), *args, timeout=timeout,
+                                   count_rows=count_rows)
+        except InvalidCachedStatementError:
+            # Schema changed after the statement was prepared
+            stmt = await self.statements.get(conn, name, reprepare=True)
+            return await self._run(name, getattr(stmt, method), *args, timeout=timeout,
+                                   count_rows=count_rows)
+
+    async def fetch_named(self, name, args=None, timeout=None, fetchmany=True):
+        """Same as fetch but uses a statement registered in self.statements"""
+        async with self.acquire(name) as conn:
+            return await self._run_named(conn, name, 'fetch' if fetchmany else 'fetchrow',
+                                         args or (), timeout=timeout)
+
+    async def fetchval_named(self, name, args=None, timeout=None):
+        async with self.acquire(name) as conn:
+            return await self._run_named(conn, name, 'fetchval', args or (), timeout=timeout)
+
+    async def execute_named(self, name, args=None, timeout=None):
+        """
+        Run a registered statement that doesn't return anything.
+        Prepared statements don't return a status string so nothing is returned
+        """
+        async with self.acquire(name) as conn:
+            await self._run_named(conn, name, 'fetch', args or (), timeout=timeout)
 
-        return row
+    @staticmethod
+    def role_fingerprint(role_ids) -> int:
+        """Order independent 64-bit fingerprint of a set of role ids"""
+        data = array('q', sorted(role_ids)).tobytes()
+        return int.from_bytes(hashlib.blake2b(data, digest_size=8).digest(), 'little', signed=True)
+
+    async def invalidate_role_fingerprint(self, user_id: int, guild_id: int = None):
+        """
+        Must be called when userroles of a user is changed outside of index_guild_member_roles
+        so the user will be reindexed on the next index
+        """
+        if guild_id is None:
+            await self.execute('DELETE FROM userroles_fingerprints WHERE uid=$1', (user_id,))
+        else:
+            await self.execute('DELETE FROM userroles_fingerprints WHERE guild=$1 AND uid=$2', (guild_id, user_id))
 
     async def index_guild_member_roles(self, guild: disnake.Guild):
+        """
+        Saves the roles of all members of the guild to userroles.
+        Only members whose role set differs from the fingerprint saved
+        on the last index are written.
+        """
         t = time.time()
         default_role = guild.default_role.id
 
-        async def execute(sql_, args=None, insertmany=False):
-            try:
-                await self.execute(sql_, args, insertmany=insertmany)
-            except PostgresError:
-                logger.exception('Failed to execute sql')
-                return False
-            return True
-
         success = await self.index_guild_roles(guild)
         if not success:
             return success
@@ -211,38 +419,51 @@ class DatabaseUtils:
             logger.info(f'added offline users in {time.time() - t1}')
         except (TypeError, ValueError):
             pass
-        _m = list(guild.members)
-        members = list(filter(lambda u: len(u.roles) > 1, _m))
-        all_members = [str(u.id) for u in _m]
-
-        t1 = time.time()
-        sql = 'DELETE FROM userroles ur USING roles r WHERE r.id=ur.role AND r.guild={} AND ur.uid IN ({})'.format(guild.id, ', '.join(all_members))
 
-        # Deletes all server records
-        # sql = 'DELETE userRoles FROM userRoles INNER JOIN roles WHERE roles.server=%s AND userRoles.role_id=roles.id'
-        if not await execute(sql):
+        try:
+            rows = await self.fetch('SELECT uid, fingerprint FROM userroles_fingerprints WHERE guild=$1', (guild.id,))
+        except PostgresError:
+            logger.exception('Failed to get role fingerprints')
             return False
-        logger.info(f'Deleted old records in {time.time() - t1}')
-        t1 = time.time()
 
-        args = []
-        for u in members:
-            uid = u.id
-            args.extend([(uid, r.id) for r in u.roles if r.id != default_role])
-
-        sql_statements = []
-        # 100k default chunk size
-        chunk_size = 100000
-        for i in range(0, len(args), chunk_size):
-            # This piece of spaghetti code basically creates the
-            # VALUES (1,2), (3,4), (5,6)...
-            # part because asyncpg doesn't support any meaningful way to do it
-            s = '(' + '),('.join(', '.join((str(u), str(r))) for u, r in args[i:i+chunk_size]) + ')'
-            sql_statements.append('INSERT INTO userroles (uid, role) VALUES %s ON CONFLICT DO NOTHING' % s)
+        old_fingerprints = {row['uid']: row['fingerprint'] for row in rows}
+
+        changed = []
+        fingerprints = []
+        uids = []
+        roles = []
+        for u in guild.members:
+            role_ids = [r.id for r in u.roles if r.id != default_role]
+            fingerprint = self.role_fingerprint(role_ids)
+            if old_fingerprints.get(u.id) == fingerprint:
+                continue
+
+            changed.append(u.id)
+            fingerprints.append(fingerprint)
+            for role_id in role_ids:
+                uids.append(u.id)
+                roles.append(role_id)
+
+        logger.info(f'{len(changed)}/{len(guild.members)} members have changed roles on guild {guild.id}')
+        if not changed:
+            return True
+
+        t1 = time.time()
+        delete_sql = 'DELETE FROM userroles ur USING roles r WHERE r.id=ur.role AND r.guild=$1 AND ur.uid=ANY($2::bigint[])'
+        insert_sql = 'INSERT INTO userroles (uid, role) SELECT * FROM unnest($1::bigint[], $2::bigint[]) ON CONFLICT DO NOTHING'
+        fingerprint_sql = 'INSERT INTO userroles_fingerprints (guild, uid, fingerprint) ' \
+                          'SELECT $3::bigint, * FROM unnest($1::bigint[], $2::bigint[]) ' \
+                          'ON CONFLICT (guild, uid) DO UPDATE SET fingerprint=EXCLUDED.fingerprint'
 
         try:
-            await self.execute_chunked(sql_statements)
+            async with self.acquire('index_guild_member_roles') as conn:
+                async with conn.transaction():
+                    await conn.execute(delete_sql, guild.id, changed)
+                    await self.execute_unnest(insert_sql, (uids, roles), chunk_size=100000, conn=conn)
+                    await self.execute_unnest(fingerprint_sql, (changed, fingerprints, guild.id),
+                                              chunk_size=100000, conn=conn)
         except PostgresError:
+            logger.exception('Failed to index guild member roles')
             return False
 
         logger.info(f'added user roles in {time.time() - t1}')
@@ -250,14 +471,13 @@ class DatabaseUtils:
         return True
 
     async def get_user_keeproles(self, guild: int, user: int):
-        sql = 'SELECT role FROM userroles ur INNER JOIN roles r ON r.id = ur.role ' \
-              'WHERE r.guild=$1 AND ur.uid=$2'
-
-        rows = await self.fetch(sql, (guild, user))
+        rows = await self.fetch_named('get_user_keeproles', (guild, user))
         return [r['role'] for r in rows]
 
     async def delete_user_role(self, guild: int, user: int, role: int):
-        sql = 'DELETE FROM userroles ur USING roles r ' \
+        # Fingerprint is invalidated in the same statement so the row count is of the userroles delete
+        sql = 'WITH fp AS (DELETE FROM userroles_fingerprints WHERE guild=$1 AND uid=$2) ' \
+              'DELETE FROM userroles ur USING roles r ' \
               'WHERE r.guild=$1 AND ur.uid=$2 AND ur.role=$3'
 
         res = await self.execute(sql, (guild, user, role))
@@ -267,16 +487,17 @@ class DatabaseUtils:
         if not await self.add_roles(guild, role):
             return False
 
-        sql = 'INSERT INTO userroles (uid, role) VALUES ($1, $2)'
+        sql = 'WITH fp AS (DELETE FROM userroles_fingerprints WHERE guild=$3 AND uid=$1) ' \
+              'INSERT INTO userroles (uid, role) VALUES ($1, $2)'
 
-        await self.execute(sql, (user, role))
+        await self.execute(sql, (user, role, guild))
         return True
 
     async def replace_user_keeproles(self, guild_id, user_id, roles):
         sql = 'DELETE FROM userroles ur using roles r ' \
               'WHERE r.guild=$1 AND ur.uid=$2'
 
-        async with self.bot.pool.acquire() as conn:
+        async with self.acquire('replace_user_keeproles') as conn:
             async with conn.transaction():
                 try:
                     await conn.execute(sql, guild_id, user_id)
@@ -288,28 +509,21 @@ class DatabaseUtils:
 
                     sql = f'INSERT INTO userroles (uid, role) VALUES {groups}'
                     await conn.execute(sql, *data)
+                    await conn.execute('DELETE FROM userroles_fingerprints WHERE guild=$1 AND uid=$2',
+                                       guild_id, user_id)
                 except PostgresError as e:
                     raise e
 
     async def index_guild_roles(self, guild):
-        guild_id = guild.id
-
-        def tuples():
-            for r in guild.roles:
-                yield r.id, guild_id
-
-        roles = _args_to_string(tuples())
-        role_ids = [str(r.id) for r in guild.roles]
-
-        # We won't be using insertmany on this so we can use ON CONFLICT
-        # Instead we prepare the args as a string beforehand. This works because
-        # they're all just integers
-        sql = 'INSERT INTO roles (id, guild) VALUES %s ON CONFLICT DO NOTHING' % roles
+        role_ids = [r.id for r in guild.roles]
 
         try:
-            await self.execute(sql)
-            sql = 'DELETE FROM roles WHERE guild={} AND NOT id IN ({})'.format(guild.id, ', '.join(role_ids))
-            await self.execute(sql)
+            async with self.acquire('index_guild_roles') as conn:
+                async with conn.transaction():
+                    sql = 'INSERT INTO roles (id, guild) SELECT unnest($1::bigint[]), $2::bigint ON CONFLICT DO NOTHING'
+                    await conn.execute(sql, role_ids, guild.id)
+                    sql = 'DELETE FROM roles WHERE guild=$1 AND NOT id=ANY($2::bigint[])'
+                    await conn.execute(sql, guild.id, role_ids)
         except PostgresError:
             logger.exception('Failed to index guild roles')
             return False
@@ -319,27 +533,24 @@ class DatabaseUtils:
         if not ids:
             return
 
-        ids = _args_to_string(ids)
-        sql = 'INSERT INTO guilds (guild) VALUES %s ON CONFLICT DO NOTHING' % ids
+        ids = list(ids)
         try:
-            await self.execute(sql)
-            sql = 'INSERT INTO prefixes (guild) VALUES %s ON CONFLICT DO NOTHING' % ids
-            await self.execute(sql)
+            async with self.acquire('add_guilds') as conn:
+                async with conn.transaction():
+                    sql = 'INSERT INTO guilds (guild) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING'
+                    await conn.execute(sql, ids)
+                    sql = 'INSERT INTO prefixes (guild) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING'
+                    await conn.execute(sql, ids)
         except PostgresError:
             logger.exception('Failed to add new servers to db')
             return False
         return True
 
     async def add_roles(self, guild_id, *role_ids):
-        def it():
-            for r in role_ids:
-                yield r, guild_id
-
-        ids = _args_to_string(it())
-        sql = 'INSERT INTO roles (id, guild) VALUES %s ON CONFLICT DO NOTHING' % ids
+        sql = 'INSERT INTO roles (id, guild) SELECT unnest($1::bigint[]), $2::bigint ON CONFLICT DO NOTHING'
 
         try:
-            await self.execute(sql)
+            await self.execute(sql, (list(role_ids), guild_id))
         except PostgresError:
             logger.exception('Failed to add roles')
             return False
@@ -347,9 +558,9 @@ class DatabaseUtils:
         return True
 
     async def add_user(self, user_id: int):
-        sql = f'INSERT INTO users (id) VALUES ({user_id}) ON CONFLICT DO NOTHING'
+        sql = 'INSERT INTO users (id) VALUES ($1) ON CONFLICT DO NOTHING'
         try:
-            await self.execute(sql)
+            await self.execute(sql, (user_id,))
         except PostgresError:
             logger.exception('Failed to add user')
             return False
@@ -357,11 +568,10 @@ class DatabaseUtils:
         return True
 
     async def add_users(self, *user_ids):
-        ids = _args_to_string(user_ids)
-        sql = 'INSERT INTO users (id) VALUES %s ON CONFLICT DO NOTHING' % ids
+        sql = 'INSERT INTO users (id) SELECT unnest($1::bigint[]) ON CONFLICT DO NOTHING'
 
         try:
-            await self.execute(sql)
+            await self.execute(sql, (list(user_ids),))
         except PostgresError:
             logger.exception('Failed to add users')
             return False
@@ -372,15 +582,11 @@ class DatabaseUtils:
         if not await self.add_roles(guild_id, *role_ids):
             return
 
-        def it():
-            for r in role_ids:
-                yield user_id, r
-
-        ids = _args_to_string(it())
-        sql = 'INSERT INTO userroles (uid, role) VALUES %s ON CONFLICT DO NOTHING' % ids
+        sql = 'WITH fp AS (DELETE FROM userroles_fingerprints WHERE guild=$3 AND uid=$1) ' \
+              'INSERT INTO userroles (uid, role) SELECT $1::bigint, unnest($2::bigint[]) ON CONFLICT DO NOTHING'
 
         try:
-            await self.execute(sql)
+            await self.execute(sql, (user_id, list(role_ids), guild_id))
         except PostgresError:
             logger.exception('Failed to add roles foreign keys')
             return False
@@ -388,7 +594,8 @@ class DatabaseUtils:
         return True
 
     async def remove_user_roles(self, role_ids, user_id: int):
-        sql = 'DELETE FROM userroles WHERE uid=%s and role IN (%s)' % (user_id, ', '.join(map(str, role_ids)))
+        sql = 'WITH fp AS (DELETE FROM userroles_fingerprints WHERE uid=%s) ' \
+              'DELETE FROM userroles WHERE uid=%s and role IN (%s)' % (user_id, user_id, ', '.join(map(str, role_ids)))
         try:
             await self.execute(sql)
             return True
@@ -416,6 +623,77 @@ class DatabaseUtils:
             logger.exception('Failed to remove prefix')
             return False
 
+    async def get_guild_settings(self, guild_ids: typing.Iterable[int] = None) -> dict[int, dict]:
+        """
+        Fetch the settings and prefixes of guilds
+
+        Args:
+            guild_ids: Guilds to fetch. All guilds are fetched if not given
+
+        Returns:
+            dict of {guild_id: settings} where settings['prefixes'] is a set of
+            the custom prefixes of the guild. The set is empty if there are none
+        """
+        sql = 'SELECT guilds.*, prefixes.prefix FROM guilds LEFT OUTER JOIN prefixes ON guilds.guild=prefixes.guild'
+        args = ()
+        if guild_ids is not None:
+            sql += ' WHERE guilds.guild=ANY($1::bigint[])'
+            args = (list(guild_ids),)
+
+        guilds = {}
+        for row in await self.fetch(sql, args):
+            settings = guilds.get(row['guild'])
+            if settings is None:
+                settings = {**row}
+                settings.pop('guild')
+                settings.pop('prefix')
+                settings['prefixes'] = set()
+                guilds[row['guild']] = settings
+
+            if row['prefix'] is not None:
+                settings['prefixes'].add(row['prefix'])
+
+        return guilds
+
+    async def update_guild_settings(self, changes: dict[tuple[int, str], typing.Any], instance_id: str):
+        """
+        Write guild setting changes in a single transaction and notify
+        other processes of the guilds that were changed.
+
+        Args:
+            changes: dict of {(guild_id, column): value}. Column names are formatted
+                     into the sql so they must not come from user input
+            instance_id: Id of the sender that is included in the notification
+        """
+        columns = {}
+        for (guild_id, column), value in changes.items():
+            columns.setdefault(column, []).append((guild_id, value))
+
+        async with self.acquire('update_guild_settings') as conn:
+            async with conn.transaction():
+                for column, args in columns.items():
+                    sql = 'INSERT INTO guilds (guild, {0}) VALUES ($1, $2) ON CONFLICT (guild) DO UPDATE SET {0}=EXCLUDED.{0}'.format(column)
+                    await self._run(query_name(sql), conn.executemany, sql, args)
+
+                # Notifications are only delivered if the transaction commits
+                await self._notify_guild_settings(conn, instance_id, {guild_id for guild_id, _ in changes})
+
+    async def _notify_guild_settings(self, conn, instance_id: str, guild_ids: typing.Iterable[int]):
+        sql = 'SELECT pg_notify($1, $2)'
+        guild_ids = list(guild_ids)
+        # Keep the payload under the 8000 byte limit of NOTIFY
+        for i in range(0, len(guild_ids), 300):
+            payload = f'{instance_id}:' + ','.join(map(str, guild_ids[i:i+300]))
+            await self._run(sql, conn.execute, sql, GUILD_SETTINGS_CHANNEL, payload)
+
+    async def notify_guild_settings(self, instance_id: str, guild_ids: typing.Iterable[int]):
+        """Notify other processes that the settings of the given guilds have changed"""
+        try:
+            async with self.acquire('notify_guild_settings') as conn:
+                await self._notify_guild_settings(conn, instance_id, guild_ids)
+        except PostgresError:
+            logger.exception('Failed to send guild settings notification')
+
     async def delete_role(self, role_id: int, guild_id: int):
         sql = f'DELETE FROM roles WHERE id={role_id} AND guild={guild_id}'
         try:
@@ -425,7 +703,8 @@ class DatabaseUtils:
 
     async def delete_user_roles(self, guild_id: int, user_id: int):
         try:
-            sql = f'DELETE FROM userroles USING roles WHERE roles.id=userroles.role AND roles.guild={guild_id} AND userroles.uid={user_id}'
+            sql = f'WITH fp AS (DELETE FROM userroles_fingerprints WHERE guild={guild_id} AND uid={user_id}) ' \
+                  f'DELETE FROM userroles USING roles WHERE roles.id=userroles.role AND roles.guild={guild_id} AND userroles.uid={user_id}'
             await self.execute(sql)
         except PostgresError:
             logger.exception('Could not delete user roles')
@@ -486,30 +765,64 @@ class DatabaseUtils:
         return success
 
     async def multiple_last_seen(self, user_ids, usernames, guild_id, timestamps):
-
-        sql_statements = []
-        args = []
-        step = 500
-
-        for i in range(0, len(user_ids), step):
-            data = []
-            for uid, u, g, t in zip(user_ids[i:i+step], usernames[i:i+step], guild_id[i:i+step], timestamps[i:i+step]):
-                data.extend((uid, u, g, t))
-
-            sql = 'INSERT INTO last_seen_users (uid, username, guild, last_seen) VALUES %s ' \
-                  'ON CONFLICT (uid, guild) DO UPDATE SET last_seen=EXCLUDED.last_seen, username=EXCLUDED.username' % self.create_bind_groups(len(data)//4, 4)
-
-            sql_statements.append(sql)
-            args.append(data)
-
         try:
-            await self.execute_chunked(sql_statements, args)
+            await self.execute_named('multiple_last_seen', (user_ids, usernames, guild_id, timestamps))
         except PostgresError:
             logger.exception('Failed to set last seen')
             return False
 
         return True
 
+    async def add_messages(self, records: list[tuple[int, int, int, int]]) -> int:
+        """
+        Insert (guild, channel, user_id, message_id) rows to the messages table.
+        Messages that already exist are skipped
+
+        Returns:
+            Amount of inserted messages
+        """
+        sql = 'INSERT INTO messages (guild, channel, user_id, message_id) ' \
+              'SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::bigint[], $4::bigint[]) ' \
+              'ON CONFLICT (message_id) DO NOTHING'
+        return await self.execute_unnest(sql, [list(column) for column in zip(*records)], chunk_size=5000)
+
+    async def add_r9k_digests(self, digests: list[bytes]):
+        await self.execute_named('add_r9k_digests', (digests,))
+
+    async def convert_legacy_r9k(self, digest: typing.Callable[[str], bytes], batch_size: int = 5000) -> int:
+        """
+        Converts the messages in the r9k_legacy table left by migration 003
+        to digests and drops the table.
+
+        Args:
+            digest: Function that creates the digest of a message
+
+        Returns:
+            Amount of converted messages
+        """
+        if not await self.fetchval("SELECT to_regclass('r9k_legacy') IS NOT NULL"):
+            return 0
+
+        sql = 'INSERT INTO r9k_digests (digest) SELECT unnest($1::bytea[]) ON CONFLICT DO NOTHING'
+        converted = 0
+        async with self.acquire('convert_legacy_r9k') as conn:
+            async with conn.transaction():
+                digests = []
+                async for row in conn.cursor('SELECT message::text FROM r9k_legacy WHERE message IS NOT NULL', prefetch=batch_size):
+                    digests.append(digest(row['message']))
+                    if len(digests) >= batch_size:
+                        await self._run(sql, conn.execute, sql, digests)
+                        converted += len(digests)
+                        digests = []
+
+                if digests:
+                    await self._run(sql, conn.execute, sql, digests)
+                    converted += len(digests)
+
+                await conn.execute('DROP TABLE r9k_legacy')
+
+        return converted
+
     async def add_command(self, parent, name=""):
         sql = 'INSERT INTO command_stats (parent, cmd) VALUES ($1, $2) ON CONFLICT DO NOTHING'
         try:
@@ -549,11 +862,54 @@ class DatabaseUtils:
                               records=values,
                               columns=('cmd', 'used_at', 'uid', 'guild'))
 
+    async def add_command_stats(self, stats, usages):
+        """
+        Write buffered command usage in one transaction
+
+        Args:
+            stats: Mapping of (parent, cmd) to the amount of uses to add
+            usages: List of (cmd, used_at, uid, guild) tuples added to command_usage
+        """
+        parents = []
+        names = []
+        uses = []
+        for (parent, name), amount in stats.items():
+            parents.append(parent)
+            names.append(name)
+            uses.append(amount)
+
+        async with self.acquire('add_command_stats') as conn:
+            async with conn.transaction():
+                if parents:
+                    await self._run_named(conn, 'add_command_stats', 'fetch', (parents, names, uses))
+
+                if usages:
+                    await self._run('COPY command_usage', conn.copy_records_to_table, 'command_usage',
+                                    records=usages, columns=('cmd', 'used_at', 'uid', 'guild'),
+                                    count_rows=self._status_rows)
+
+    async def add_mention_stats(self, counts):
+        """
+        Args:
+            counts: Mapping of (guild, role) to [amount, role_name]
+        """
+        guilds = []
+        roles = []
+        amounts = []
+        names = []
+        for (guild, role), (amount, name) in counts.items():
+            guilds.append(guild)
+            roles.append(role)
+            amounts.append(amount)
+            names.append(name)
+
+        await self.execute_named('add_mention_stats', (guilds, roles, amounts, names))
+
     async def command_used(self, parent, name, used_at, user_id=None, guild=None):
         if name is None:
             name = ""
 
-        async with self.bot.pool.acquire() as conn:
+        async with self.acquire('command_used') as conn:
             async with conn.transaction():
                 sql = 'UPDATE command_stats SET uses=(uses+1) WHERE parent=$1 AND cmd=$2'
                 try:
@@ -626,7 +982,7 @@ class DatabaseUtils:
             sql += f' LIMIT {int(limit)}'
 
         try:
-            return await self.fetch(sql, (*names, after))
+            return await self.fetch(sql, (*names, after), workload=Workload.ANALYTICS)
         except PostgresError:
             logger.exception('Failed to get command stats')
             return False
@@ -678,10 +1034,35 @@ class DatabaseUtils:
     async def botban(self, user_id: int, reason):
         sql = 'INSERT INTO banned_users (uid, reason) VALUES ($1, $2)'
         await self.execute(sql, (user_id, reason))
+        self.bot.banned_users.add(user_id)
 
     async def botunban(self, user_id: int):
         sql = 'DELETE FROM banned_users WHERE uid=%s' % user_id
         await self.execute(sql)
+        self.bot.banned_users.discard(user_id)
+
+    async def get_banned_users(self) -> set[int]:
+        rows = await self.fetch('SELECT uid FROM banned_users')
+        return {row['uid'] for row in rows}
+
+    async def get_bot_staff(self) -> dict[int, int]:
+        rows = await self.fetch('SELECT uid, auth_level FROM bot_staff')
+        return {row['uid']: row['auth_level'] for row in rows}
+
+    async def set_staff_auth(self, user_id: int, auth_level: int):
+        """
+        Set the auth level of a user. Auth level 0 removes the user from staff
+        """
+        if auth_level <= 0:
+            sql = 'DELETE FROM bot_staff WHERE uid=$1'
+            await self.execute(sql, (user_id,))
+            self.bot.bot_staff.pop(user_id, None)
+            return
+
+        sql = 'INSERT INTO bot_staff (uid, auth_level) VALUES ($1, $2) ' \
+              'ON CONFLICT (uid) DO UPDATE SET auth_level=EXCLUDED.auth_level'
+        await self.execute(sql, (user_id, auth_level))
+        self.bot.bot_staff[user_id] = auth_level
 
     async def blacklist_guild(self, guild_id: int, reason):
         sql = 'INSERT INTO guild_blacklist (guild, reason) VALUES ($1, $2)'
@@ -715,7 +1096,7 @@ class DatabaseUtils:
         logger.debug(f'Adding timeout to {user} on guild {guild}')
 
         sql = 'INSERT INTO timeouts (guild, uid, expires_on) VALUES ' \
-              '%s ON CONFLICT (guild, uid) DO UPDATE SET expires_on=$3'
+              '%s ON CONFLICT (guild, uid) DO UPDATE SET expires_on=$3, claimed_until=NULL'
 
         if isinstance(user, int):
             arg_string = '($1, $2, $3)'
@@ -744,7 +1125,7 @@ class DatabaseUtils:
 
     async def add_temprole(self, user, role, guild, expires_at):
         sql = 'INSERT INTO temproles (uid, role, guild, expires_at) VALUES ' \
-              '($1, $2, $3, $4) ON CONFLICT (role, uid) DO UPDATE SET expires_at=$4'
+              '($1, $2, $3, $4) ON CONFLICT (role, uid) DO UPDATE SET expires_at=$4, claimed_until=NULL'
 
         try:
             await self.execute(sql, (user, role, guild, expires_at))
@@ -764,32 +1145,63 @@ class DatabaseUtils:
 
         return await self.fetch(sql, (guild, user))
 
+    async def get_timeouts(self):
+        sql = 'SELECT guild, uid, expires_on FROM timeouts'
+        return await self.fetch(sql)
+
+    async def claim_expired_timeouts(self, now, claimed_until, limit=100):
+        """
+        Claim timeouts that have expired and aren't claimed by anyone else.
+        The claim is released by deleting the row or when claimed_until passes
+        """
+        sql = 'WITH due AS (SELECT guild, uid FROM timeouts ' \
+              '    WHERE expires_on <= $1 AND (claimed_until IS NULL OR claimed_until <= $1) ' \
+              '    ORDER BY expires_on LIMIT $3 FOR UPDATE SKIP LOCKED) ' \
+              'UPDATE timeouts t SET claimed_until=$2 FROM due ' \
+              'WHERE t.guild=due.guild AND t.uid=due.uid ' \
+              'RETURNING t.guild, t.uid'
+
+        return await self.fetch(sql, (now, claimed_until, limit))
+
+    async def claim_expired_temproles(self, now, claimed_until, limit=100):
+        """Same as claim_expired_timeouts but for temproles"""
+        sql = 'WITH due AS (SELECT role, uid FROM temproles ' \
+              '    WHERE expires_at <= $1 AND (claimed_until IS NULL OR claimed_until <= $1) ' \
+              '    ORDER BY expires_at LIMIT $3 FOR UPDATE SKIP LOCKED) ' \
+              'UPDATE temproles t SET claimed_until=$2 FROM due ' \
+              'WHERE t.role=due.role AND t.uid=due.uid ' \
+              'RETURNING t.guild, t.uid, t.role'
+
+        return await self.fetch(sql, (now, claimed_until, limit))
+
+    async def next_expiring_event(self, now):
+        """
+        Get the expiry of the next timeout or temprole that expires after now.
+        Both subqueries are answered by the expiry indexes
+        """
+        sql = 'SELECT LEAST(' \
+              '(SELECT MIN(expires_on) FROM timeouts WHERE expires_on > $1), ' \
+              '(SELECT MIN(expires_at) FROM temproles WHERE expires_at > $1))'
+
+        return await self.fetchval(sql, (now,))
+
     async def add_changes(self, changes):
         sql = 'INSERT INTO changelog (changes) VALUES ($1) RETURNING id'
         rowid = await self.fetchval(sql, (changes, ))
         return rowid
 
     async def index_join_dates(self, guild):
-        sql = "INSERT INTO join_dates (uid, guild, first_join) VALUES %s ON CONFLICT DO NOTHING"
-        chunk_size = 10000
-        values = []
-        sqls = []
+        sql = 'INSERT INTO join_dates (uid, guild, first_join) ' \
+              'SELECT u, $3::bigint, j FROM unnest($1::bigint[], $2::timestamptz[]) AS t(u, j) ON CONFLICT DO NOTHING'
         members = guild.members.copy()
+        uids = [m.id for m in members]
+        joined = [m.joined_at for m in members]
 
-        for i in range(0, len(members), chunk_size):
-            data = []
-            for m in members[i:i+chunk_size]:
-                data.extend((m.id, guild.id, m.joined_at.replace(tzinfo=None)))
-
-            values.append(data)
-            sqls.append(sql % self.create_bind_groups(len(data)//3, 3))
-
-        await self.execute_chunked(sqls, values)
+        await self.execute_unnest(sql, (uids, joined, guild.id), chunk_size=10000)
 
     async def get_join_date(self, uid: int, guild_id: int):
-        sql = f"SELECT first_join FROM join_dates WHERE uid={uid} AND guild={guild_id}"
         try:
-            row = await self.fetch(sql, fetchmany=False)
+            row = await self.fetch_named('get_join_date', (uid, guild_id), fetchmany=False)
         except PostgresError:
             return None
 
@@ -927,10 +1339,8 @@ class DatabaseUtils:
         return row
 
     async def get_timezone(self, user_id: int):
-        sql = f'SELECT timezone FROM users WHERE id={user_id}'
-
         try:
-            row = await self.fetch(sql, fetchmany=False)
+            row = await self.fetch_named('get_timezone', (user_id,), fetchmany=False)
             if row:
                 return row['timezone']
         except PostgresError:
@@ -971,7 +1381,7 @@ class DatabaseUtils:
                           max_winners=1,
                           giveaway=False,
                           allow_n_votes=None):
-        async with self.bot.pool.acquire() as conn:
+        async with self.acquire('create_poll') as conn:
             tr = conn.transaction()
             await tr.start()
             sql = 'INSERT INTO polls (guild, title, strict, message, channel, expires_in, ignore_on_dupe, multiple_votes, max_winners, giveaway, allow_n_votes) ' \
@@ -1032,6 +1442,35 @@ class DatabaseUtils:
 
         return True
 
+    async def update_poll_votes(self, added, removed):
+        """
+        Save changes to the live poll vote tallies
+
+        Args:
+            added: List of (poll_id, emote, user_id, is_bot, voted_at) tuples
+            removed: List of (poll_id, emote, user_id) tuples
+        """
+        async with self.acquire('update_poll_votes') as conn:
+            async with conn.transaction():
+                if removed:
+                    sql = 'DELETE FROM poll_votes v ' \
+                          'USING unnest($1::bigint[], $2::text[], $3::bigint[]) AS t(poll_id, emote, uid) ' \
+                          'WHERE v.poll_id=t.poll_id AND v.emote=t.emote AND v.uid=t.uid'
+                    await self.execute_unnest(sql, [list(a) for a in zip(*removed)], conn=conn)
+
+                if added:
+                    # Votes of polls that have already ended are skipped by the join
+                    sql = 'INSERT INTO poll_votes (poll_id, emote, uid, is_bot, voted_at) ' \
+                          'SELECT t.* FROM unnest($1::bigint[], $2::text[], $3::bigint[], $4::bool[], $5::timestamptz[]) ' \
+                          '    AS t(poll_id, emote, uid, is_bot, voted_at) ' \
+                          'INNER JOIN polls p ON p.message=t.poll_id ' \
+                          'ON CONFLICT DO NOTHING'
+                    await self.execute_unnest(sql, [list(a) for a in zip(*added)], conn=conn)
+
+    async def get_poll_votes(self):
+        sql = 'SELECT poll_id, emote, uid, is_bot FROM poll_votes ORDER BY voted_at'
+        return await self.fetch(sql)
+
     async def get_event_points(self, user_id: int) -> int:
         sql = 'SELECT points FROM event_users WHERE uid=$1'
         retval = await self.fetchval(sql, (user_id,))
@@ -0,0 +1,118 @@
+import asyncio
+import logging
+import typing
+from datetime import datetime, timedelta
+
+from utils.utilities import utcnow
+
+if typing.TYPE_CHECKING:
+    from bot.botbase import BotBase
+
+logger = logging.getLogger('terminal')
+
+
+class ExpiringEventQueue:
+    """
+    Runs expired timeouts and temproles using the database tables as a job queue.
+
+    Expired rows are claimed by setting claimed_until on them and the handlers
+    are expected to delete the row once the event has been handled.
+    If that doesn't happen the claim runs out after claim_time seconds
+    and the row will be claimed again.
+
+    Only one wakeup is scheduled at a time. It's set to the expiry of the
+    next event in the database, which is a single index lookup, or to
+    max_sleep seconds if that is sooner. New events are passed to notify
+    so the wakeup can be moved earlier when needed.
+    Starting the queue processes everything that expired while the bot was down.
+    """
+    KEY = 'expiring_events'
+
+    def __init__(self, bot: 'BotBase',
+                 on_timeout: typing.Callable[[int, int], typing.Awaitable],
+                 on_temprole: typing.Callable[[int, int, int], typing.Awaitable],
+                 claim_time: int = 300, max_sleep: int = 900, batch_size: int = 100):
+        """
+        Args:
+            bot: The bot instance
+            on_timeout: Async function called with (user_id, guild_id) when a timeout expires
+            on_temprole: Async function called with (user_id, role_id, guild_id) when a temprole expires
+            claim_time: How long a claimed event is reserved for this process in seconds
+            max_sleep: Maximum time between checks in seconds
+            batch_size: Maximum amount of events of one type claimed at once
+        """
+        self._bot = bot
+        self._on_timeout = on_timeout
+        self._on_temprole = on_temprole
+        self.claim_time = claim_time
+        self.max_sleep = max_sleep
+        self.batch_size = batch_size
+        self._started = False
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def started(self) -> bool:
+        return self._started
+
+    def start(self):
+        self._started = True
+        self._wake_at(utcnow())
+
+    def stop(self):
+        self._started = False
+        self.bot.scheduler.cancel(self.KEY)
+
+    def notify(self, expires_at: datetime):
+        """Make sure the queue is checked when an event with the given expiry is due"""
+        if self._started:
+            self._wake_at(expires_at)
+
+    def _wake_at(self, when: datetime):
+        call = self.bot.scheduler.get(self.KEY)
+        if call is not None and call.runs_at <= when:
+            return
+
+        self.bot.scheduler.schedule_at(self.KEY, when, self._process)
+
+    async def _process(self):
+        now = utcnow()
+        claimed_until = now + timedelta(seconds=self.claim_time)
+        dbutil = self.bot.dbutil
+
+        try:
+            timeouts = await dbutil.claim_expired_timeouts(now, claimed_until, self.batch_size)
+            temproles = await dbutil.claim_expired_temproles(now, claimed_until, self.batch_size)
+            next_expiry = await dbutil.next_expiring_event(now)
+        except Exception:
+            logger.exception('Failed to claim expiring events')
+            if self._started:
+                self._wake_at(utcnow() + timedelta(seconds=60))
+            return
+
+        jobs = [self._on_timeout(row['uid'], row['guild']) for row in timeouts]
+        jobs.extend(self._on_temprole(row['uid'], row['role'], row['guild']) for row in temproles)
+
+        try:
+            if jobs:
+                logger.debug(f'Processing {len(timeouts)} timeouts and {len(temproles)} temproles')
+                for result in await asyncio.gather(*jobs, return_exceptions=True):
+                    if isinstance(result, Exception):
+                        logger.error('Failed to process expiring event', exc_info=result)
+        finally:
+            # Always schedule the next check so the queue can't stall
+            if self._started:
+                self._schedule_next(timeouts, temproles, next_expiry)
+
+    def _schedule_next(self, timeouts, temproles, next_expiry):
+        if len(timeouts) >= self.batch_size or len(temproles) >= self.batch_size:
+            # More events are waiting
+            when = utcnow()
+        else:
+            when = utcnow() + timedelta(seconds=self.max_sleep)
+            if next_expiry is not None:
+                when = min(when, next_expiry)
+
+        self._wake_at(when)
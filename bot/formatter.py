@@ -4,14 +4,13 @@ import operator
 
 import colors
 import disnake
-from asyncpg.exceptions import PostgresError
 from disnake import Embed
 from disnake.ext.commands import help, BucketType, CooldownMapping, is_owner
 from disnake.ext.commands.errors import CommandError
 
 from bot.commands import Command
 from bot.exceptions import CommandBlacklisted
-from utils.utilities import check_perms
+from bot.globals import PermValues
 
 terminal = logging.getLogger('terminal')
 
@@ -36,55 +35,30 @@ class HelpCommand(help.HelpCommand):
         return self.context.invoked_with == 'helpall'
 
     @staticmethod
-    async def _get_db_perms(ctx):
-        user = ctx.author
-        channel = ctx.channel
-        is_guild = ctx.guild is not None
-
-        if isinstance(user, disnake.Member) and len(user.roles) > 1:
-            roles = '(role IS NULL OR role IN ({}))'.format(', '.join(map(lambda r: str(r.id), user.roles)))
-        else:
-            roles = 'role IS NULL'
-
-        guild_owner = False if (not is_guild or not ctx.guild.owner_id) else user.id == ctx.guild.owner_id
-        command_blacklist = {}
-
-        # Filter by custom blacklist
-        if not guild_owner and is_guild:
-            sql = 'SELECT type, role, uid, channel, command FROM command_blacklist WHERE guild=$1 ' \
-                  'AND (uid IS NULL OR uid=$2) AND {} AND (channel IS NULL OR channel=$3)'.format(roles)
-
-            try:
-                rows = await ctx.bot.dbutil.fetch(sql, (ctx.guild.id, user.id, channel.id))
-
-                for row in rows:
-                    name = row['command']
-                    if name in command_blacklist:
-                        command_blacklist[name].append(row)
-                    else:
-                        command_blacklist[name] = [row]
+    def check_blacklist(commands, ctx):
+        """
+        Filter commands based on the command blacklist of the guild.
+        Only permissions set for specific commands are checked here.
 
-            except PostgresError:
-                terminal.exception('Failed to get role blacklist for help command')
+        Returns:
+            tuple of (commands with no permissions set, whitelisted commands)
+        """
+        user = ctx.author
+        if ctx.guild is None or user.id == ctx.guild.owner_id:
+            return commands, ()
 
-        return command_blacklist
-
-    @staticmethod
-    def check_blacklist(commands, command_blacklist):
-        def check(command):
-            rows = command_blacklist.get(command.name, None)
-            if not rows:
-                return None
-            return check_perms(rows)
+        cache = ctx.bot.blacklist_cache
+        guild_id = ctx.guild.id
+        channel_id = ctx.channel.id
 
         new_commands = []
         whitelist = []
         for cmd in commands:
-            retval = check(cmd)
-            if retval:
-                whitelist.append(cmd)
-            elif retval is None:
+            value = cache.get_perm(guild_id, cmd.name, user, channel_id, include_all_commands=False)
+            if value is None:
                 new_commands.append(cmd)
+            elif PermValues.RETURNS.get(value, False):
+                whitelist.append(cmd)
 
         return new_commands, whitelist
 
@@ -130,10 +104,7 @@ class HelpCommand(help.HelpCommand):
             return cog.qualified_name + ':' if cog is not None else 'No category'
 
         if not skip_checks:
-            command_blacklist = await self._get_db_perms(ctx)
-            whitelisted = ()
-            if command_blacklist:
-                commands, whitelisted = self.check_blacklist(commands, command_blacklist)
+            commands, whitelisted = self.check_blacklist(commands, ctx)
 
             # We dont wanna check db perms again for each individual command
             ctx.skip_check = True
@@ -176,10 +147,7 @@ class HelpCommand(help.HelpCommand):
         commands = cog.get_commands()
 
         if not skip_checks:
-            command_blacklist = await self._get_db_perms(ctx)
-            whitelisted = ()
-            if command_blacklist:
-                commands, whitelisted = self.check_blacklist(commands, command_blacklist)
+            commands, whitelisted = self.check_blacklist(commands, ctx)
 
             # We dont wanna check db perms again for each individual command
             ctx.skip_check = True
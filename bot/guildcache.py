@@ -1,13 +1,113 @@
+import asyncio
+import logging
+import uuid
+from typing import Iterable, Optional
+
+import asyncpg
 from asyncpg.exceptions import PostgresError
 
+from bot.dbutil import GUILD_SETTINGS_CHANNEL
 from bot.exceptions import (NotEnoughPrefixes, PrefixExists,
                             PrefixDoesntExist)
 
+logger = logging.getLogger('terminal')
+
+
+class PrefixTrie:
+    """
+    Trie of command prefixes. match walks the trie one character at a time
+    so it stops as soon as the message can't start with any prefix.
+    Nodes are dicts where the None key holds the prefix ending at that node
+    """
+    __slots__ = ('_root',)
+
+    def __init__(self, prefixes: Iterable[str] = ()):
+        self._root = {}
+        for prefix in prefixes:
+            self.add(prefix)
+
+    def add(self, prefix: str):
+        node = self._root
+        for c in prefix:
+            node = node.setdefault(c, {})
+        node[None] = prefix
+
+    def match(self, s: str) -> Optional[str]:
+        """Returns the longest prefix s starts with or None"""
+        node = self._root
+        found = node.get(None)
+        for c in s:
+            node = node.get(c)
+            if node is None:
+                break
+
+            found = node.get(None, found)
+
+        return found
+
+
+class GuildSettings:
+    """
+    Cached settings of a single guild. Attributes are the columns of the guilds table.
+    prefixes is None when the guild only uses the default prefix
+    """
+    COLUMNS = ('mute_role', 'modlog', 'on_delete_channel', 'on_edit_channel',
+               'keeproles', 'on_join_channel', 'on_leave_channel',
+               'on_join_message', 'on_leave_message', 'color_on_join',
+               'on_edit_message', 'on_delete_message', 'automute',
+               'automute_limit', 'automute_time', 'on_delete_embed',
+               'on_edit_embed', 'dailygachi', 'last_banner', 'log_unmutes',
+               'banner_delay', 'banner_delay_start', 'icon_delay',
+               'icon_delay_start')
+
+    __slots__ = COLUMNS + ('prefixes', 'prefix_list', 'prefix_trie')
+    _FIELDS = frozenset(COLUMNS + ('prefixes',))
+
+    def __init__(self, **values):
+        for name in self.__slots__:
+            setattr(self, name, None)
+
+        self.update(**values)
+
+    def update(self, **values):
+        """Sets the given values. Keys that aren't settings are ignored"""
+        for k, v in values.items():
+            if k in self._FIELDS:
+                setattr(self, k, v)
+
+    def reset_prefixes(self):
+        self.prefix_list = None
+        self.prefix_trie = None
+
 
 class GuildCache:
-    def __init__(self, bot):
+    """
+    In memory copy of the guilds table.
+
+    Changes made with set_value are applied to the cache immediately and
+    written to the database in batches after flush_delay seconds.
+    Written guilds are announced on the guild_settings channel so other
+    processes using the same database can reload them.
+    """
+    FLUSH_KEY = 'guild_settings_flush'
+    RELOAD_KEY = 'guild_settings_reload'
+    LISTENER_KEY = 'guild_settings_listener'
+
+    def __init__(self, bot, flush_delay: float = 1):
         self._bot = bot
-        self.guilds = {}
+        self.guilds: dict[int, GuildSettings] = {}
+        self.flush_delay = flush_delay
+        # Used to ignore notifications sent by this process
+        self.instance_id = uuid.uuid4().hex
+        # (guild_id, column) -> value
+        self._pending: dict[tuple[int, str], object] = {}
+        # Cached values from before the pending changes. Restored if a write fails
+        self._originals: dict[tuple[int, str], object] = {}
+        self._flush_future: Optional[asyncio.Future] = None
+        self._flush_lock = asyncio.Lock()
+        self._stale: set[int] = set()
+        self._listener: Optional[asyncpg.Connection] = None
+        self._listening = False
 
     @property
     def bot(self):
@@ -18,84 +118,233 @@ class GuildCache:
         Updates a servers cached values. None values are ignored
         """
         settings = self.get_settings(guild_id)
-        for k, v in values.items():
-            if v is None:
-                continue
+        settings.update(**{k: v for k, v in values.items() if v is not None})
+        settings.reset_prefixes()
 
-            settings[k] = v
+    def set_guild(self, guild_id, values: dict):
+        """
+        Replaces the cached settings of a guild with values loaded from the database.
+        Changes that haven't been written yet are kept
+        """
+        settings = GuildSettings(**values)
+        if not settings.prefixes:
+            settings.prefixes = None
 
-        # Reverse sort prefixes so some prefixes don't get overlooked
-        # e.q. if you add a prefix a and then a prefix aa if the a prefix is
-        # first in the list it will always get invoked when aa is used
-        self._set_internal_value(guild_id, 'prefixes', sorted(list(self.prefixes(guild_id, use_set=True)), reverse=True))
+        for (guild, name), value in self._pending.items():
+            if guild == guild_id:
+                setattr(settings, name, value)
+
+        self.guilds[guild_id] = settings
+
+    async def load(self, guild_ids: Iterable[int] = None):
+        """Load the settings of the given guilds or all guilds from the database"""
+        rows = await self.bot.dbutil.get_guild_settings(guild_ids)
+        for guild_id, values in rows.items():
+            self.set_guild(guild_id, values)
 
     async def set_value(self, guild_id, name, value):
-        # WARNING sql injection could happen if user input is allowed to the name var
-        sql = 'INSERT INTO guilds (guild, {0}) VALUES ($1, $2) ON CONFLICT (guild) DO UPDATE SET {0}=$2'.format(name)
-        try:
-            await self.bot.dbutil.execute(sql, (guild_id, value))
-            success = True
-        except PostgresError:
-            success = False
-        settings = self.get_settings(guild_id)
-        settings[name] = value
-        return success
+        """
+        Set a setting of a guild. The cached value is updated immediately.
+        Waits until the change has been written to the database.
+
+        Returns:
+            Whether the database write succeeded
+        """
+        # Column names are formatted into the sql so only known columns are allowed
+        if name not in GuildSettings.COLUMNS:
+            raise ValueError(f'{name} is not a guild setting')
 
-    # Used for setting cached values not present in the database or in a different form
-    # e.g. cache a set as a list. Used only for prefixes as we need them stored in a
-    # sorted list when checking for usable prefixes and a set when adding more
-    # to the list
-    def _set_internal_value(self, guild_id, name, value):
         settings = self.get_settings(guild_id)
-        internals = settings.get('_internals')
-        if internals is None:
-            internals = {}
-            settings['_internals'] = internals
+        key = (guild_id, name)
+        self._originals.setdefault(key, getattr(settings, name))
+        setattr(settings, name, value)
+        self._pending[key] = value
 
-        internals[name] = value
+        future = self._flush_future
+        if future is None:
+            future = self.bot.loop.create_future()
+            self._flush_future = future
+            self.bot.scheduler.schedule(self.FLUSH_KEY, self.flush_delay, self.flush)
 
-    def _get_internals(self, guild_id):
-        settings = self.get_settings(guild_id)
-        internals = settings.get('_internals')
-        if internals is None:
-            internals = {}
-            settings['_internals'] = internals
+        failed = await asyncio.shield(future)
+        return key not in failed
 
-        return internals
+    async def flush(self):
+        """
+        Write all pending setting changes.
+        Cached values of changes that couldn't be written are reverted
+        """
+        async with self._flush_lock:
+            # Does nothing when called by the scheduled flush itself
+            self.bot.scheduler.cancel(self.FLUSH_KEY)
+            future, self._flush_future = self._flush_future, None
+            changes, self._pending = self._pending, {}
+            originals, self._originals = self._originals, {}
+
+            failed = set(changes)
+            try:
+                if changes:
+                    failed = await self._write_changes(changes)
+            finally:
+                self._revert(failed, originals)
+                if future is not None and not future.done():
+                    future.set_result(failed)
+
+    async def _write_changes(self, changes: dict[tuple[int, str], object]) -> set[tuple[int, str]]:
+        """
+        Returns:
+            Keys of the changes that failed to be written
+        """
+        dbutil = self.bot.dbutil
+        try:
+            await dbutil.update_guild_settings(changes, self.instance_id)
+            return set()
+        except Exception:
+            logger.exception(f'Failed to write {len(changes)} guild setting changes')
+
+        if len(changes) == 1:
+            return set(changes)
+
+        # Write the changes one by one so one bad value doesn't fail the whole batch
+        failed = set()
+        for key, value in changes.items():
+            try:
+                await dbutil.update_guild_settings({key: value}, self.instance_id)
+            except Exception:
+                logger.exception(f'Failed to set {key[1]} of guild {key[0]}')
+                failed.add(key)
+
+        return failed
+
+    def _revert(self, failed: set[tuple[int, str]], originals: dict[tuple[int, str], object]):
+        for key in failed:
+            # A newer value was set while writing and will be written next.
+            # If that fails too the value from before this batch is restored
+            if key in self._pending:
+                self._originals[key] = originals[key]
+                continue
+
+            guild_id, name = key
+            settings = self.guilds.get(guild_id)
+            if settings is not None:
+                setattr(settings, name, originals[key])
+
+    async def start_listener(self):
+        """
+        Listen for guild setting changes made by other processes.
+        Reconnects automatically if the connection is lost
+        """
+        reconnect = self._listening
+        self._listening = True
+        try:
+            conn = await asyncpg.connect(**self.bot.db_connect_args())
+            await conn.add_listener(GUILD_SETTINGS_CHANNEL, self._on_notification)
+        except (PostgresError, OSError, asyncio.TimeoutError):
+            logger.exception('Failed to listen for guild setting changes')
+            self.bot.scheduler.schedule(self.LISTENER_KEY, 60, self.start_listener)
+            return
+
+        conn.add_termination_listener(self._on_listener_closed)
+        self._listener = conn
+
+        # Notifications sent while disconnected were lost
+        if reconnect and self.guilds:
+            self._stale.update(self.guilds)
+            self.bot.scheduler.schedule(self.RELOAD_KEY, 0, self._reload)
+
+    async def close(self):
+        """Stops listening for changes and writes pending changes"""
+        self._listening = False
+        self.bot.scheduler.cancel(self.LISTENER_KEY)
+        if self._listener is not None:
+            conn, self._listener = self._listener, None
+            await conn.close()
+
+        await self.flush()
+
+    def _on_listener_closed(self, conn):
+        if self._listener is conn:
+            self._listener = None
+
+        if self._listening:
+            logger.warning('Guild settings listener disconnected. Reconnecting')
+            self.bot.scheduler.schedule(self.LISTENER_KEY, 10, self.start_listener)
+
+    def _on_notification(self, conn, pid, channel, payload: str):
+        instance_id, _, guild_ids = payload.partition(':')
+        if instance_id == self.instance_id:
+            return
+
+        try:
+            guild_ids = {int(guild_id) for guild_id in guild_ids.split(',') if guild_id}
+        except ValueError:
+            logger.warning(f'Invalid guild settings notification {payload}')
+            return
+
+        # Only guilds cached by this process need to be reloaded
+        guild_ids.intersection_update(self.guilds)
+        if not guild_ids:
+            return
+
+        # Reload in one query even if multiple notifications arrive close to each other
+        self._stale.update(guild_ids)
+        if self.RELOAD_KEY not in self.bot.scheduler:
+            self.bot.scheduler.schedule(self.RELOAD_KEY, 0.5, self._reload)
+
+    async def _reload(self):
+        guild_ids, self._stale = self._stale, set()
+        if not guild_ids:
+            return
+
+        try:
+            await self.load(guild_ids)
+        except (PostgresError, OSError, asyncio.TimeoutError):
+            logger.exception('Failed to reload guild settings')
 
     # utils
     def prefixes(self, guild_id, use_set=False):
+        settings = self.get_settings(guild_id)
         if use_set:
-            return self.get_settings(guild_id).get('prefixes', {self.bot.default_prefix})
+            return settings.prefixes or {self.bot.default_prefix}
+
+        # Reverse sort prefixes so some prefixes don't get overlooked
+        # e.q. if you add a prefix a and then a prefix aa if the a prefix is
+        # first in the list it will always get invoked when aa is used
+        if settings.prefix_list is None:
+            if settings.prefixes:
+                settings.prefix_list = sorted(settings.prefixes, reverse=True)
+            else:
+                settings.prefix_list = [self.bot.default_prefix] if isinstance(self.bot.default_prefix, str) else list(self.bot.default_prefix)
+
+        return settings.prefix_list
 
-        prefixes = self._get_internals(guild_id).get('prefixes')
-        if prefixes is None:
-            prefixes = list(self.get_settings(guild_id).get('prefixes', [self.bot.default_prefix] if isinstance(self.bot.default_prefix, str) else self.bot.default_prefix))
-            self._set_internal_value(guild_id, 'prefixes', prefixes)
+    def prefix_trie(self, guild_id) -> PrefixTrie:
+        """Prefixes of the guild as a trie. Rebuilt after the prefixes change"""
+        settings = self.get_settings(guild_id)
+        if settings.prefix_trie is None:
+            settings.prefix_trie = PrefixTrie(self.prefixes(guild_id))
 
-        return prefixes
+        return settings.prefix_trie
 
     async def add_prefix(self, guild_id, prefix):
         settings = self.get_settings(guild_id)
-        if 'prefixes' not in settings:
-            prefixes = {self.bot.default_prefix}
-            settings['prefixes'] = prefixes
-        else:
-            prefixes = self.prefixes(guild_id, use_set=True)
+        if settings.prefixes is None:
+            settings.prefixes = {self.bot.default_prefix}
 
+        prefixes = settings.prefixes
         if prefix in prefixes:
             raise PrefixExists('Prefix is already in use')
 
         success = await self.bot.dbutil.add_prefix(guild_id, prefix)
         if success:
-            prefixes_list = self.prefixes(guild_id)
-            prefixes_list.append(prefix)
-            prefixes_list.sort(reverse=True)
             prefixes.add(prefix)
+            settings.reset_prefixes()
+            await self.bot.dbutil.notify_guild_settings(self.instance_id, (guild_id,))
 
         return success
 
     async def remove_prefix(self, guild_id, prefix):
+        settings = self.get_settings(guild_id)
         prefixes = self.prefixes(guild_id, use_set=True)
         if prefix not in prefixes:
             raise PrefixDoesntExist("Prefix doesn't exist")
@@ -106,34 +355,32 @@ class GuildCache:
         success = await self.bot.dbutil.remove_prefix(guild_id, prefix)
         if success:
             prefixes.discard(prefix)
-            try:
-                self.prefixes(guild_id).remove(prefix)
-            except ValueError:
-                pass
+            settings.reset_prefixes()
+            await self.bot.dbutil.notify_guild_settings(self.instance_id, (guild_id,))
 
         return success
 
     # moderation
     def modlog(self, guild_id):
-        return self.get_settings(guild_id).get('modlog', None)
+        return self.get_settings(guild_id).modlog
 
     async def set_modlog(self, guild_id, channel_id):
         return await self.set_value(guild_id, 'modlog', channel_id)
 
     def mute_role(self, guild_id):
-        return self.get_settings(guild_id).get('mute_role', None)
+        return self.get_settings(guild_id).mute_role
 
     async def set_mute_role(self, guild_id, role_id):
         return await self.set_value(guild_id, 'mute_role', role_id)
 
     def log_unmutes(self, guild_id):
-        return self.get_settings(guild_id).get('log_unmutes', False)
+        return self.get_settings(guild_id).log_unmutes or False
 
     async def set_log_unmutes(self, guild_id, boolean):
         return await self.set_value(guild_id, 'log_unmutes', boolean)
 
     def keeproles(self, guild_id):
-        if self.get_settings(guild_id).get('keeproles', 0):
+        if self.get_settings(guild_id).keeproles:
             return True
         else:
             return False
@@ -143,26 +390,27 @@ class GuildCache:
 
     # automod
     def automute(self, guild_id):
-        return self.get_settings(guild_id).get('automute', False)
+        return self.get_settings(guild_id).automute or False
 
     async def set_automute(self, guild_id, on: bool):
         return await self.set_value(guild_id, 'automute', on)
 
     def automute_limit(self, guild_id):
-        return self.get_settings(guild_id).get('automute_limit', 10)
+        limit = self.get_settings(guild_id).automute_limit
+        return limit if limit is not None else 10
 
     async def set_automute_limit(self, guild_id, limit: int):
         return await self.set_value(guild_id, 'automute_limit', limit)
 
     def automute_time(self, guild_id):
-        return self.get_settings(guild_id).get('automute_time')
+        return self.get_settings(guild_id).automute_time
 
     async def set_automute_time(self, guild_id, time):
         return await self.set_value(guild_id, 'automute_time', time)
 
     # join config
     def join_message(self, guild_id, default_message=False):
-        message = self.get_settings(guild_id).get('on_join_message')
+        message = self.get_settings(guild_id).on_join_message
         if message is None and default_message:
             message = self.bot.config.join_message
 
@@ -172,21 +420,21 @@ class GuildCache:
         return await self.set_value(guild_id, 'on_join_message', message)
 
     def join_channel(self, guild_id):
-        return self.get_settings(guild_id).get('on_join_channel')
+        return self.get_settings(guild_id).on_join_channel
 
     async def set_join_channel(self, guild_id, channel):
         return await self.set_value(guild_id, 'on_join_channel', channel)
 
     # random color on join
     def random_color(self, guild_id):
-        return self.get_settings(guild_id).get('color_on_join', False)
+        return self.get_settings(guild_id).color_on_join or False
 
     async def set_random_color(self, guild_id, value):
         return await self.set_value(guild_id, 'color_on_join', value)
 
     # leave config
     def leave_message(self, guild_id, default_message=False):
-        message = self.get_settings(guild_id).get('on_leave_message')
+        message = self.get_settings(guild_id).on_leave_message
         if message is None and default_message:
             message = self.bot.config.leave_message
 
@@ -196,14 +444,14 @@ class GuildCache:
         return await self.set_value(guild_id, 'on_leave_message', message)
 
     def leave_channel(self, guild_id):
-        return self.get_settings(guild_id).get('on_leave_channel')
+        return self.get_settings(guild_id).on_leave_channel
 
     async def set_leave_channel(self, guild_id, channel):
         return await self.set_value(guild_id, 'on_leave_channel', channel)
 
     # On message edit
     def on_edit_message(self, guild_id, default_message=False):
-        message = self.get_settings(guild_id).get('on_edit_message')
+        message = self.get_settings(guild_id).on_edit_message
         if message is None and default_message:
             message = self.bot.config.edit_message
 
@@ -213,20 +461,20 @@ class GuildCache:
         return await self.set_value(guild_id, 'on_edit_message', message)
 
     def on_edit_channel(self, guild_id):
-        return self.get_settings(guild_id).get('on_edit_channel')
+        return self.get_settings(guild_id).on_edit_channel
 
     async def set_on_edit_channel(self, guild_id, channel):
         return await self.set_value(guild_id, 'on_edit_channel', channel)
 
     def on_edit_embed(self, guild_id):
-        return self.get_settings(guild_id).get('on_edit_embed')
+        return self.get_settings(guild_id).on_edit_embed
 
     async def set_on_edit_embed(self, guild_id, boolean):
         return await self.set_value(guild_id, 'on_edit_embed', boolean)
 
     # On message delete
     def on_delete_message(self, guild_id, default_message=False):
-        message = self.get_settings(guild_id).get('on_delete_message')
+        message = self.get_settings(guild_id).on_delete_message
         if message is None and default_message:
             message = self.bot.config.delete_message
 
@@ -236,27 +484,27 @@ class GuildCache:
         return await self.set_value(guild_id, 'on_delete_message', message)
 
     def on_delete_channel(self, guild_id):
-        return self.get_settings(guild_id).get('on_delete_channel')
+        return self.get_settings(guild_id).on_delete_channel
 
     async def set_on_delete_channel(self, guild_id, channel):
         return await self.set_value(guild_id, 'on_delete_channel', channel)
 
     def on_delete_embed(self, guild_id):
-        return self.get_settings(guild_id).get('on_delete_embed')
+        return self.get_settings(guild_id).on_delete_embed
 
     async def set_on_delete_embed(self, guild_id, boolean):
         return await self.set_value(guild_id, 'on_delete_embed', boolean)
 
     def dailygachi(self, guild_id):
-        return self.get_settings(guild_id).get('dailygachi')
+        return self.get_settings(guild_id).dailygachi
 
     async def set_dailygachi(self, guild_id, channel):
         return await self.set_value(guild_id, 'dailygachi', channel)
 
-    def get_settings(self, guild_id):
+    def get_settings(self, guild_id) -> GuildSettings:
         settings = self[guild_id]
-        if not settings:
-            settings = {}
+        if settings is None:
+            settings = GuildSettings()
             self[guild_id] = settings
 
         return settings
@@ -74,7 +74,7 @@ class MusicPlayer:
         self.activity_check = None
         self._speed_mod = 1
         self._skip_votes = set()
-        self._stop_votes = TimedSet(loop=self.bot.loop)
+        self._stop_votes = TimedSet()
         self.persistent_filters = {}
         self.gapless = False
 
@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import typing
+from collections import Counter
+
+from asyncpg.exceptions import UniqueViolationError
+from disnake.ext import tasks
+
+if typing.TYPE_CHECKING:
+    from bot.botbase import BotBase
+
+logger = logging.getLogger('terminal')
+
+
+class CommandUsageRecorder:
+    """
+    Buffers command usage in memory and writes it to the database in bulk.
+
+    Usage counts are aggregated per command and the command_usage rows
+    are queued. Both are flushed when the queue reaches max_size or
+    when flush_interval seconds have passed since the last flush.
+    """
+    def __init__(self, bot: 'BotBase', max_size: int = 500, flush_interval: float = 30):
+        self._bot = bot
+        self.max_size = max_size
+        self._stats: Counter[tuple[str, str]] = Counter()
+        self._usages: list[tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: typing.Optional[asyncio.Task] = None
+        self._flush_loop.change_interval(seconds=flush_interval)
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def queue_depth(self) -> int:
+        """Amount of usage rows waiting to be written"""
+        return len(self._usages)
+
+    def start(self):
+        self._flush_loop.start()
+
+    async def close(self):
+        """Stops the flush loop and writes everything still in the buffer"""
+        self._flush_loop.cancel()
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+
+        await self.flush()
+
+    def record(self, parent: str, name: str, used_at, user_id: int = None, guild: int = None):
+        name = name or ''
+        self._stats[(parent, name)] += 1
+
+        cmd = parent
+        if name:
+            cmd += ' ' + name
+        self._usages.append((cmd, used_at, user_id, guild))
+
+        if len(self._usages) >= self.max_size and (self._flush_task is None or self._flush_task.done()):
+            self._flush_task = asyncio.create_task(self.flush(), name='flush_command_usage')
+            self._flush_task.add_done_callback(self._log_flush_error)
+
+    @staticmethod
+    def _log_flush_error(task: asyncio.Task):
+        if not task.cancelled() and task.exception() is not None:
+            logger.error('Command usage flush failed', exc_info=task.exception())
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._usages and not self._stats:
+                return
+
+            stats, self._stats = self._stats, Counter()
+            usages, self._usages = self._usages, []
+
+            try:
+                await self.bot.dbutil.add_command_stats(stats, usages)
+            except Exception:
+                logger.exception(f'Failed to write {len(usages)} command uses. Requeueing them')
+                self._stats.update(stats)
+                # Keep the queue bounded if the database stays unavailable
+                self._usages = (usages + self._usages)[-self.max_size * 10:]
+
+    @tasks.loop(seconds=30)
+    async def _flush_loop(self):
+        await self.flush()
+
+
+class MessageIngestor:
+    """
+    Collects rows for the messages table and writes them with COPY
+    every flush_interval seconds.
+
+    The queue is bounded by max_size. When it's full new messages are dropped
+    instead of blocking the caller. The amount of dropped messages is kept in
+    the dropped attribute.
+    """
+    def __init__(self, bot: 'BotBase', max_size: int = 20000, flush_interval: float = 2):
+        self._bot = bot
+        self.max_size = max_size
+        self.dropped = 0
+        self._queue: list[tuple] = []
+        self._flush_lock = asyncio.Lock()
+        self._flush_loop.change_interval(seconds=flush_interval)
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        self._flush_loop.start()
+
+    async def close(self):
+        self._flush_loop.cancel()
+        await self.flush()
+
+    def add(self, guild: int, channel: int, user_id: int, message_id: int) -> bool:
+        """
+        Queue a message to be written.
+
+        Returns:
+            False if the message was dropped because the queue is full
+        """
+        if len(self._queue) >= self.max_size:
+            self.dropped += 1
+            return False
+
+        self._queue.append((guild, channel, user_id, message_id))
+        return True
+
+    async def flush(self):
+        async with self._flush_lock:
+            if self.dropped:
+                logger.warning(f'Message queue was full. Dropped {self.dropped} messages')
+                self.dropped = 0
+
+            if not self._queue:
+                return
+
+            records, self._queue = self._queue, []
+
+            # Failed batches aren't requeued so a batch that keeps failing
+            # can't block newer messages from being written
+            try:
+                await self.bot.dbutil.insertmany('messages', records=records,
+                                                 columns=('guild', 'channel', 'user_id', 'message_id'))
+                return
+            except UniqueViolationError:
+                # COPY can't skip conflicts so one duplicate fails the whole batch
+                pass
+            except Exception:
+                logger.exception(f'Failed to write {len(records)} messages')
+                return
+
+            try:
+                await self.bot.dbutil.add_messages(records)
+            except Exception:
+                logger.exception(f'Failed to write {len(records)} messages')
+
+    @tasks.loop(seconds=2)
+    async def _flush_loop(self):
+        await self.flush()
+
+
+class MentionStatsAggregator:
+    """
+    Aggregates role mention counts in memory and writes them to mention_stats
+    every flush_interval seconds with a single upsert.
+
+    Counts that haven't been written yet can be read with pending so
+    that stats shown to users stay exact.
+    """
+    def __init__(self, bot: 'BotBase', flush_interval: float = 60):
+        self._bot = bot
+        # (guild, role) -> [amount, role_name]
+        self._counts: dict[tuple[int, int], list] = {}
+        # Counts that are being written. Included in pending until the write finishes
+        self._flushing: dict[tuple[int, int], list] = {}
+        self._flush_lock = asyncio.Lock()
+        self._flush_loop.change_interval(seconds=flush_interval)
+
+    @property
+    def bot(self):
+        return self._bot
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._counts)
+
+    def start(self):
+        self._flush_loop.start()
+
+    async def close(self):
+        self._flush_loop.cancel()
+        await self.flush()
+
+    def add(self, guild_id: int, role_id: int, role_name: str, amount: int = 1):
+        key = (guild_id, role_id)
+        value = self._counts.get(key)
+        if value is None:
+            self._counts[key] = [amount, role_name]
+        else:
+            value[0] += amount
+            value[1] = role_name
+
+    def pending(self, guild_id: int) -> dict[int, tuple[int, str]]:
+        """
+        Returns the unwritten mention counts of a guild as {role_id: (amount, role_name)}
+        """
+        pending = {role: (amount, name) for (guild, role), (amount, name) in self._flushing.items()
+                   if guild == guild_id}
+        for (guild, role), (amount, name) in self._counts.items():
+            if guild != guild_id:
+                continue
+
+            old = pending.get(role)
+            pending[role] = (amount + old[0], name) if old else (amount, name)
+
+        return pending
+
+    async def flush(self):
+        async with self._flush_lock:
+            if not self._counts:
+                return
+
+            counts, self._counts = self._counts, {}
+            self._flushing = counts
+
+            try:
+                await self.bot.dbutil.add_mention_stats(counts)
+            except Exception:
+                logger.exception('Failed to write mention stats. Requeueing them')
+                for key, (amount, name) in counts.items():
+                    value = self._counts.get(key)
+                    if value is None:
+                        self._counts[key] = [amount, name]
+                    else:
+                        # Keep the newer role name
+                        value[0] += amount
+            finally:
+                self._flushing = {}
+
+    @tasks.loop(seconds=60)
+    async def _flush_loop(self):
+        await self.flush()
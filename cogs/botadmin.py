@@ -35,7 +35,7 @@ from redis.asyncio import Redis
 from bot.bot import command
 from bot.config import Config
 from bot.converters import CommandConverter, PossibleUser
-from bot.globals import SFX_FOLDER
+from bot.globals import SFX_FOLDER, Auth
 from cogs.cog import Cog
 from utils.utilities import (DateAccuracy, basic_check, call_later, check_import, format_timedelta,
                              is_owner, parse_timeout, seconds2str, split_string, test_url, utcnow,
@@ -368,6 +368,8 @@ class BotAdmin(Cog):
 
         try:
             await self._bot.pool.close()
+            if self._bot.analytics_pool:
+                await self._bot.analytics_pool.close()
         except asyncio.exceptions.CancelledError:
             pass
         except:
@@ -587,6 +589,74 @@ class BotAdmin(Cog):
 
         await ctx.send(f'Removed the botban of {name}`{user_id}`')
 
+    @command()
+    async def dbstats(self, ctx, sort='total', limit: int = 10):
+        """
+        Show query statistics collected by DatabaseUtils.
+        Sort can be one of total, count, max, avg, acquire or rows.
+        Use reset as the sort value to reset the statistics
+        """
+        dbutil = self.bot.dbutil
+        query_stats = dbutil.query_stats
+        if sort == 'reset':
+            query_stats.reset()
+            return await ctx.send('Query stats reset')
+
+        pool = self.bot.pool
+        s = f'Collecting since {datetime.fromtimestamp(query_stats.started_at):%Y-%m-%d %H:%M:%S}\n' \
+            f'Pool size {pool.get_size()}/{pool.get_max_size()}, idle {pool.get_idle_size()}\n' \
+            f'Prepared statements {dbutil.statements.stats()}\n'
+
+        analytics = self.bot.analytics_pool
+        if analytics:
+            s += f'Analytics pool size {analytics.get_size()}/{analytics.get_max_size()}, idle {analytics.get_idle_size()}\n'
+
+        recorder = getattr(self.bot, 'command_recorder', None)
+        if recorder:
+            s += f'Command usage queue {recorder.queue_depth}\n'
+
+        s += '\n'
+        for name, stat in query_stats.top(sort, limit):
+            avg = stat.total_time / stat.count * 1000 if stat.count else 0
+            acquire = stat.acquire_time / stat.acquires * 1000 if stat.acquires else 0
+            s += f'{name}\n' \
+                 f'    n={stat.count} err={stat.errors} total={stat.total_time:.2f}s avg={avg:.1f}ms ' \
+                 f'p50={stat.percentile(0.5):.0f}ms p95={stat.percentile(0.95):.0f}ms max={stat.max_time*1000:.0f}ms ' \
+                 f'rows={stat.rows} acquire avg={acquire:.1f}ms max={stat.max_acquire_time*1000:.0f}ms\n'
+
+        if query_stats.slow_queries:
+            s += f'\nSlow queries (>{query_stats.slow_threshold*1000:.0f}ms)\n'
+            for ts, name, elapsed, rows in reversed(query_stats.slow_queries):
+                s += f'{datetime.fromtimestamp(ts):%H:%M:%S} {elapsed*1000:.0f}ms {rows} rows {name}\n'
+
+        for msg in split_string(s, maxlen=1990, splitter='\n'):
+            await ctx.send(f'```\n{msg}```')
+
+    @command()
+    async def set_staff(self, ctx, user: PossibleUser, auth_level: int):
+        """
+        Set the bot staff auth level of a user. Auth level 0 removes the user from staff
+        """
+        if isinstance(user, BaseUser):
+            name = user.name + ' '
+            user_id = user.id
+
+        else:
+            name = ''
+            user_id = user
+
+        level = Auth.to_string(auth_level)
+        if level is None:
+            return await ctx.send(f'Invalid auth level {auth_level}')
+
+        try:
+            await self.bot.dbutil.set_staff_auth(user_id, auth_level)
+        except PostgresError:
+            logger.exception(f'Failed to set auth level of user {name}{user_id}')
+            return await ctx.send(f'Failed to set auth level of user {name}`{user_id}`')
+
+        await ctx.send(f'Set auth level of {name}`{user_id}` to {level}')
+
     @command()
     async def leave_guild(self, ctx, guild_id: int):
         g = self.bot.get_guild(guild_id)
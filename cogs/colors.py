@@ -5,16 +5,19 @@ import os
 import re
 import shlex
 import typing
+from collections import Counter
 from io import BytesIO
 from math import ceil, sqrt
+from threading import Lock
 
 import disnake
 import numpy
-import matplotlib.pyplot as plt
 from PIL import Image, ImageDraw, ImageFont
 from asyncpg.exceptions import PostgresError
 from colormath.color_conversions import convert_color
 from colormath.color_diff import delta_e_cie2000
+from colormath.color_diff_matrix import \
+    delta_e_cie2000 as delta_e_cie2000_matrix
 from colormath.color_objects import LabColor, sRGBColor
 from colour import Color as Colour
 from disnake.ext import commands
@@ -27,6 +30,8 @@ from bot.globals import WORKING_DIR
 from bot.paginator import Paginator
 from cogs.cog import Cog
 from utils.imagetools import stack_images, concatenate_images
+from utils.timedset import TimedDict
+from utils.trigram import TrigramIndex
 from utils.utilities import (split_string, get_role, y_n_check, y_check,
                              Snowflake, check_botperm, get_text_size)
 
@@ -86,6 +91,61 @@ class Color:
         return self.to_rgb()
 
 
+def _lab_values(color) -> tuple[float, float, float]:
+    lab = color.lab if isinstance(color, Color) else color
+    return lab.lab_l, lab.lab_a, lab.lab_b
+
+
+class ColorIndex:
+    """
+    Lab values of a palette stored in a numpy array so that distances to
+    every color can be calculated with one vectorized CIEDE2000 call.
+    Colors are also indexed by their lowercase name.
+    Indexes are immutable and should be rebuilt when the palette changes
+    """
+    __slots__ = ('colors', 'lab', 'names')
+
+    def __init__(self, colors: typing.Iterable):
+        """
+        Args:
+            colors: Color or LabColor instances
+        """
+        self.colors = list(colors)
+        self.lab = numpy.array([_lab_values(c) for c in self.colors], dtype=float).reshape(-1, 3)
+        self.names = {}
+        for c in self.colors:
+            if isinstance(c, Color):
+                # First color with a name is used like in disnake.utils.find
+                self.names.setdefault(str(c.name).lower(), c)
+
+    def __len__(self):
+        return len(self.colors)
+
+    def distances(self, color) -> numpy.ndarray:
+        """CIEDE2000 differences between the given color and every color in the index"""
+        return delta_e_cie2000_matrix(numpy.array(_lab_values(color), dtype=float), self.lab)
+
+    def nearest(self, color, k: int = 1) -> list[tuple[typing.Any, float]]:
+        """
+        Returns:
+            List of the k closest colors and their similarity (100 - delta E)
+            ordered from closest to furthest
+        """
+        if not self.colors:
+            return []
+
+        d = self.distances(color)
+        if k == 1:
+            idx = [int(numpy.argmin(d))]
+        elif k < len(d):
+            idx = numpy.argpartition(d, k - 1)[:k]
+            idx = idx[numpy.argsort(d[idx], kind='stable')]
+        else:
+            idx = numpy.argsort(d, kind='stable')
+
+        return [(self.colors[i], 100 - float(d[i])) for i in idx]
+
+
 class Colors(Cog):
     def __init__(self, bot):
         super().__init__(bot)
@@ -93,19 +153,71 @@ class Colors(Cog):
         self._colors = {}
         self.bot.colors = self._colors
         self._color_jobs = set()
+        # {guild_id: ColorIndex} Built when needed and removed when the colors of the guild change
+        self._color_indexes: dict[int, ColorIndex] = {}
+        # {guild_id: (palette hash, png bytes)} Rendered images of the colors command
+        self._palette_renders = TimedDict(ttl=3600, max_size=100)
+        # {guild_id: Counter({color value: member count})} Built on first use
+        # and kept up to date from member events
+        self._color_counts: dict[int, Counter] = {}
+        # {hash of pie rows: png bytes}
+        self._colorpie_renders = TimedDict(ttl=600, max_size=50)
+        self._colorpie_font = ImageFont.truetype(
+            os.path.join(WORKING_DIR, 'M-1c', 'mplus-1c-medium.ttf'),
+            encoding='utf-8', size=15)
+        # Font objects aren't safe to use from multiple threads at once
+        self._colorpie_lock = Lock()
 
         with open(os.path.join(os.getcwd(), 'data', 'color_names.json'), 'r', encoding='utf-8') as f:
             self._color_names = json.load(f)
 
+        self._color_name_search = TrigramIndex(self._color_names.keys())
+
+        # Index of the named colors. Built on cog load as every name needs a lab conversion
+        self._name_index: typing.Optional[ColorIndex] = None
+
+    def _build_name_index(self):
+        return ColorIndex(Color.from_hex(name, color['hex'], set_lab=True)
+                          for name, color in self._color_names.items())
+
+    def _named_color_lab(self, name) -> LabColor:
+        """Lab value of a color from color_names.json"""
+        if self._name_index is not None:
+            color = self._name_index.names.get(name)
+            if color is not None:
+                return color.lab
+
+        return Color.from_hex(name, self._color_names[name]['hex'], set_lab=True).lab
+
     async def cog_load(self):
         await super().cog_load()
         await self._cache_colors()
+        self._name_index = await self.bot.loop.run_in_executor(self.bot.threadpool, self._build_name_index)
+
+    def _invalidate_colors(self, guild_id: int):
+        """Must be called whenever colors of a guild are added, removed or modified"""
+        self._color_indexes.pop(guild_id, None)
+        self._palette_renders.pop(guild_id)
+
+    def color_index(self, guild_id: int) -> ColorIndex:
+        index = self._color_indexes.get(guild_id)
+        if index is None:
+            index = ColorIndex(self._colors.get(guild_id, {}).values())
+            self._color_indexes[guild_id] = index
+
+        return index
 
     @Cog.listener()
     async def on_ready(self):
+        # Member events might have been missed while disconnected
+        self._color_counts.clear()
         logger.debug('Caching colors')
         await self._cache_colors()
 
+    @Cog.listener()
+    async def on_guild_available(self, guild: disnake.Guild):
+        self._color_counts.pop(guild.id, None)
+
     async def _cache_colors(self):
         sql = 'SELECT colors.id, colors.name, colors.value, roles.guild, colors.lab_l, colors.lab_a, colors.lab_b FROM ' \
               'colors LEFT OUTER JOIN roles on roles.id=colors.id'
@@ -246,6 +358,7 @@ class Colors(Cog):
 
         color.value = role.color.value
         color.lab = lab
+        self._invalidate_colors(color.guild_id)
         await self._add_color2db(color, update=True)
         return color
 
@@ -268,6 +381,8 @@ class Colors(Cog):
         else:
             self._colors[guild_id] = {id: color}
 
+        self._invalidate_colors(guild_id)
+
         if role.color.value != value:
             await self._update_color(color, role)
         else:
@@ -280,6 +395,7 @@ class Colors(Cog):
     async def _delete_color(self, guild_id, role_id):
         try:
             color = self._colors[guild_id].pop(role_id)
+            self._invalidate_colors(guild_id)
             logger.debug(f'Deleting color {color.name} with value {color.value} from guild {guild_id}')
         except KeyError:
             logger.debug(f'Deleting color {role_id} from guild {guild_id} if it existed')
@@ -287,22 +403,22 @@ class Colors(Cog):
         await self.bot.dbutils.delete_role(role_id, guild_id)
 
     def get_color(self, name, guild_id):
-        name = name.lower()
-        return disnake.utils.find(lambda n: str(n[1]).lower() == name,
-                                  self._colors.get(guild_id, {}).items())
-
-    def search_color_(self, name):
-        name = name.lower()
+        color = self.color_index(guild_id).names.get(name.lower())
+        if color is None:
+            return
 
-        matches = []
-        for color, value in self._color_names.items():
-            if color == name:
-                matches.insert(0, (color, value))
+        return color.role_id, color
 
-            elif name in color:
-                matches.append((color, value))
+    def search_color_(self, name, limit=500):
+        """
+        Search named colors that contain the given name
 
-        return matches
+        Returns:
+            List of (name, color) tuples ordered by how well they match.
+            At most limit results are returned
+        """
+        return [(color, self._color_names[color])
+                for color in self._color_name_search.search(name.lower(), limit=limit)]
 
     def match_color(self, color, convert2discord=True):
         color = color.lower()
@@ -329,26 +445,19 @@ class Colors(Cog):
 
     @staticmethod
     def closest_color_match(color, colors):
-        if isinstance(color, Color):
-            lab = color.lab
-        else:
-            lab = color
-
-        closest_match = None
-        similarity = None
-        for c in colors:
-            if isinstance(c, Color):
-                clab = c.lab
-            else:
-                clab = c
+        """
+        Args:
+            color: Color or LabColor to match
+            colors: ColorIndex or an iterable of Color or LabColor instances
 
-            d = 100 - delta_e_cie2000(lab, clab)
-            if similarity is None or d > similarity:
-                similarity = d
-                closest_match = c
+        Returns:
+            tuple of the closest color and the similarity percentage
+        """
+        if not isinstance(colors, ColorIndex):
+            colors = ColorIndex(colors)
 
-        similarity = round(similarity, 2)
-        return closest_match, similarity
+        closest_match, similarity = colors.nearest(color)[0]
+        return closest_match, round(similarity, 2)
 
     def closest_match(self, color, guild):
         colors = self._colors.get(guild.id)
@@ -360,14 +469,58 @@ class Colors(Cog):
             return
 
         color = self.rgb2lab(rgb)
-        return self.closest_color_match(color, colors.values())
+        return self.closest_color_match(color, self.color_index(guild.id))
+
+    def member_color_counts(self, guild: disnake.Guild) -> Counter:
+        """Amount of members with each display color in the guild"""
+        counts = self._color_counts.get(guild.id)
+        if counts is None:
+            counts = Counter(m.color.value for m in guild.members)
+            # Counts of partially cached guilds would go out of sync
+            if guild.chunked:
+                self._color_counts[guild.id] = counts
+
+        return counts
+
+    def _count_member_color(self, member: disnake.Member, amount: int):
+        counts = self._color_counts.get(member.guild.id)
+        if counts is None:
+            return
+
+        value = member.color.value
+        counts[value] += amount
+        if counts[value] <= 0:
+            del counts[value]
+
+    @Cog.listener()
+    async def on_member_join(self, member):
+        self._count_member_color(member, 1)
+
+    @Cog.listener()
+    async def on_member_remove(self, member):
+        self._count_member_color(member, -1)
+
+    @Cog.listener()
+    async def on_member_update(self, before, after):
+        if before.color != after.color:
+            self._count_member_color(before, -1)
+            self._count_member_color(after, 1)
+
+    @Cog.listener()
+    async def on_guild_remove(self, guild):
+        self._color_counts.pop(guild.id, None)
 
     @Cog.listener()
     async def on_guild_role_delete(self, role):
+        # Member colors change without member update events
+        self._color_counts.pop(role.guild.id, None)
         await self._delete_color(role.guild.id, role.id)
 
     @Cog.listener()
     async def on_guild_role_update(self, before, after):
+        if before.color != after.color or before.position != after.position:
+            self._color_counts.pop(before.guild.id, None)
+
         if before.color.value != after.color.value:
             color = self._colors.get(before.guild.id, {}).get(before.id)
             if not color:
@@ -375,6 +528,7 @@ class Colors(Cog):
 
             if before.name != after.name and before.name == color.name:
                 color.name = after.name
+                self._invalidate_colors(before.guild.id)
 
             await self._update_color(color, after, to_role=False)
 
@@ -384,6 +538,7 @@ class Colors(Cog):
                 return
 
             color.name = after.name
+            self._invalidate_colors(before.guild.id)
             await self._add_color2db(color, update=True)
 
     async def _add_colors_from_roles(self, roles, ctx: Context):
@@ -409,6 +564,7 @@ class Colors(Cog):
             if await self._add_color2db(color):
                 await ctx.send('Color {} created'.format(role))
                 colors[role.id] = color
+                self._invalidate_colors(guild.id)
             else:
                 await ctx.send('Failed to create color {0.name}'.format(role))
 
@@ -665,17 +821,40 @@ class Colors(Cog):
         return s
 
     def sort_by_color(self, colors):
+        """
+        Orders colors by starting from the one closest to black and always
+        picking the closest remaining color next.
+
+        Args:
+            colors: ColorIndex or an iterable of Color instances
+
+        Returns:
+            list of the sorted colors
+        """
+        if not isinstance(colors, ColorIndex):
+            colors = ColorIndex(colors)
+
+        if not colors:
+            return []
+
         start = self.rgb2lab((0,0,0), to_role=None)
-        color, _ = self.closest_color_match(start, colors)
-        sorted_colors = [color]
-        colors.remove(color)
+        current = int(numpy.argmin(colors.distances(start)))
+        used = numpy.zeros(len(colors), dtype=bool)
+        order = []
 
-        while colors:
-            closest, _ = self.closest_color_match(sorted_colors[-1], colors)
-            colors.remove(closest)
-            sorted_colors.append(closest)
+        # Rows of the distance matrix are only calculated for the colors
+        # that are visited so the full matrix never needs to be stored
+        while True:
+            order.append(current)
+            used[current] = True
+            if len(order) == len(colors):
+                break
 
-        return sorted_colors
+            d = delta_e_cie2000_matrix(colors.lab[current], colors.lab)
+            d[used] = numpy.inf
+            current = int(numpy.argmin(d))
+
+        return [colors.colors[i] for i in order]
 
     # https://stackoverflow.com/a/3943023/6046713
     @staticmethod
@@ -727,6 +906,22 @@ class Colors(Cog):
     def _sorted_color_image(self, colors):
         return self._color_image(self.sort_by_color(colors))
 
+    async def guild_color_image(self, guild_id: int) -> BytesIO:
+        """
+        Sorted image of the colors of a guild. Images are cached until the colors change
+        """
+        colors = self._colors.get(guild_id, {})
+        key = hash(tuple((c.role_id, c.name, c.value) for c in colors.values()))
+
+        cached = self._palette_renders.get(guild_id)
+        if cached is None or cached[0] != key:
+            data = await self.bot.loop.run_in_executor(self.bot.threadpool, self._sorted_color_image,
+                                                       self.color_index(guild_id))
+            cached = (key, data.getvalue())
+            self._palette_renders[guild_id] = cached
+
+        return BytesIO(cached[1])
+
     def _color_image(self, colors):
         size = (100, 100)
         side = ceil(sqrt(len(colors)))
@@ -780,7 +975,7 @@ class Colors(Cog):
             return
 
         try:
-            data = await self.bot.loop.run_in_executor(self.bot.threadpool, self._sorted_color_image, list(colors.values()))
+            data = await self.guild_color_image(guild.id)
         except OSError:
             logger.exception('Failed to generate colors')
             await ctx.send('Failed to generate colors. Try again later')
@@ -835,91 +1030,103 @@ class Colors(Cog):
         return color2name
 
     @staticmethod
-    def _get_colorpie(members, color2name):
+    def _colorpie_rows(counts: dict[int, int], color2name) -> tuple[tuple[str, str, int], ...]:
         """
-
         Args:
-            members (list of disnake.Member): Members to be used in colorpie
-            color2name (dict[str, str]): Convert hex strings to color names
+            counts: Amount of members per color value
+            color2name (dict[int, str]): Convert color values to color names
 
         Returns:
-            color pie image
+            tuple of (hex, label, amount) tuples ordered from the most common color
         """
+        rows = []
+        for value, amount in sorted(counts.items(), key=lambda kv: (-kv[1], kv[0])):
+            if amount <= 0:
+                continue
 
-        # dict of
-        # hex value: amount of users with said value
-        role_data: dict[int, int] = {}
-
-        for m in members:
-            val = m.color.value
-            if val in role_data:
-                role_data[val] += 1
-            else:
-                role_data[val] = 1
-
-        member_count = sum(role_data.values())
-
-        data = list(sorted(role_data.items(), key=lambda kv: kv[1], reverse=True))
-        values_count = [d[1] for d in data]
-        colors = [d[0] for d in data]
-        colors_hex = ['#B9BBBE' if c == 0 else '#' + hex(c)[2:].zfill(6).upper()
-                      for c in colors]
-
-        # Values normalized
-        values = [count / member_count for count in values_count]
-
-        color_text = []
-        used_color_lengths = [len(color2name.get(c, colors_hex[i])) for i, c in
-                              enumerate(colors)]
-        maxlen = max(used_color_lengths)
-
-        for i, c in enumerate(colors):
-            # Percentage that always has 4 numbers 00.00%
-            p = '{:>5.2%}'.format(values[i]).zfill(6)
-
-            c = color2name.get(c, colors_hex[i])
+            hex_color = '#B9BBBE' if value == 0 else f'#{value:06X}'
+            rows.append((hex_color, color2name.get(value, hex_color), amount))
 
-            padding = maxlen - len(c)
+        return tuple(rows)
 
-            # We wanna center the - so we pad from both sides
-            lpad = ceil(padding / 2)
-            rpad = padding // 2
-            color_text.append(f'{c} {" " * lpad}-{" " * rpad} {p} ({values_count[i]})')
+    def _draw_colorpie(self, rows) -> BytesIO:
+        """
+        Draws a pie chart and a legend of the rows from _colorpie_rows with PIL
+        """
+        font = self._colorpie_font
+        total = sum(row[2] for row in rows)
+        # Percentage that always has 4 numbers 00.00%
+        stats = ['{:>5.2%}'.format(amount / total).zfill(6) + f' ({amount})' for _, _, amount in rows]
+        title = f'Colors ({len(rows)})'
+
+        pad = 10
+        line_height = 22
+        swatch = 14
+        with self._colorpie_lock:
+            name_width = max(get_text_size(font, label)[0] for _, label, _ in rows)
+            stat_width = max(get_text_size(font, stat)[0] for stat in stats)
+            dash_width = get_text_size(font, '-')[0]
+
+            legend_width = swatch + name_width + dash_width + stat_width + pad*3
+            legend_height = line_height * (len(rows) + 1)
+            # Pie grows with the legend so it stays readable with lots of colors
+            diameter = min(max(240, legend_height), 1000)
+            # Supersampling factor used to antialias the pie
+            scale = 4 if diameter <= 400 else 2
+
+            width = diameter + legend_width + pad*5
+            height = max(diameter, legend_height) + pad*2
+            im = Image.new('RGB', (width, height), 'white')
+
+            pie = Image.new('RGB', (diameter*scale, diameter*scale), 'white')
+            draw = ImageDraw.Draw(pie)
+            start = -90.0
+            for hex_color, _, amount in rows:
+                end = start + 360 * amount / total
+                draw.pieslice((0, 0, diameter*scale - 1, diameter*scale - 1), start, end, fill=hex_color)
+                start = end
+
+            pie = pie.resize((diameter, diameter), Image.Resampling.LANCZOS)
+            im.paste(pie, (pad, (height - diameter) // 2))
+
+            draw = ImageDraw.Draw(im)
+            x = diameter + pad*3
+            y = (height - legend_height) // 2 + line_height // 2
+            draw.text((x + legend_width // 2, y), title, font=font, fill='black', anchor='mm')
+
+            for (hex_color, label, _), stat in zip(rows, stats):
+                y += line_height
+                draw.rectangle((x, y - swatch // 2, x + swatch, y + swatch // 2),
+                               fill=hex_color, outline='black')
+                tx = x + swatch + pad
+                draw.text((tx, y), label, font=font, fill='black', anchor='lm')
+                tx += name_width + pad
+                draw.text((tx, y), '-', font=font, fill='black', anchor='lm')
+                tx += dash_width + pad + stat_width
+                draw.text((tx, y), stat, font=font, fill='black', anchor='rm')
+
+        buf = BytesIO()
+        im.save(buf, 'PNG')
+        buf.seek(0)
+        return buf
 
-        # Create plot with 2 columns
-        fig, ax = plt.subplots(1, 2, figsize=(3, 3), subplot_kw={'aspect': 'equal'})
+    async def _get_colorpie(self, counts: dict[int, int], color2name) -> typing.Optional[BytesIO]:
+        """
+        Returns:
+            color pie image or None if there's nothing to draw
+        """
+        rows = self._colorpie_rows(counts, color2name)
+        if not rows:
+            return
 
-        try:
-            # Scale radius based on amount of colors. This is because picture
-            # size increases when color amount increases
-            wedges, texts = ax[0].pie(values, colors=colors_hex,
-                                      radius=len(colors) / 5, normalize=False)
-
-            ax[1].axis('off')
-            x = len(colors)
-            x = sqrt(x) / 2 + min(2.0, (x * x) / 2000) + (maxlen - 7) / 28
-            f = ax[1].legend(wedges, color_text,
-                             title=f"Colors ({len(colors)})",
-                             loc="center",
-                             # We need to move the anchor point based on circle radius
-                             # and longest text. These values were created by trial and error
-                             bbox_to_anchor=(x, 0, 0, 1))
-
-            # We wanna use monospace font so everything aligns nicely
-            plt.setp(f.texts, family='monospace')
-
-            buf = BytesIO()
-            # bbox_inches='tight' makes it so picture is extended just enough to fit everything
-            plt.savefig(buf, format='png', bbox_inches='tight')
-            plt.close(fig)
-
-        except Exception as e:
-            # In case of exception just close figure
-            plt.close(fig)
-            raise e
+        key = hash(rows)
+        data = self._colorpie_renders.get(key)
+        if data is None:
+            buf = await self.bot.loop.run_in_executor(self.bot.threadpool, self._draw_colorpie, rows)
+            data = buf.getvalue()
+            self._colorpie_renders[key] = data
 
-        buf.seek(0)
-        return buf
+        return BytesIO(data)
 
     @group(aliases=['colorpie'], invoke_without_command=True)
     @cooldown(1, 10, BucketType.guild)
@@ -935,11 +1142,9 @@ class Colors(Cog):
         """
         guild = ctx.guild
 
-        def do():
-            return self._get_colorpie(guild.members.copy(), self._format_color_names(guild, all_roles))
-
         async with ctx.typing():
-            data = await self.bot.loop.run_in_executor(self.bot.threadpool, do)
+            data = await self._get_colorpie(self.member_color_counts(guild),
+                                            self._format_color_names(guild, all_roles))
 
         if not data:
             return
@@ -962,11 +1167,9 @@ class Colors(Cog):
             await ctx.send(f'No members found with at least {role_amount} roles')
             return
 
-        def do():
-            return self._get_colorpie(members, self._format_color_names(guild, all_roles))
-
         async with ctx.typing():
-            data = await self.bot.loop.run_in_executor(self.bot.threadpool, do)
+            data = await self._get_colorpie(Counter(m.color.value for m in members),
+                                            self._format_color_names(guild, all_roles))
 
         if not data:
             return
@@ -1037,7 +1240,13 @@ class Colors(Cog):
             return
 
         def do_pic():
-            colors = [Color.from_hex(name.replace('-', ' '), color['hex'], bool(sort)) for name, color in matches[page:page+page_size]]
+            colors = []
+            for name, color in matches[page:page+page_size]:
+                c = Color.from_hex(name.replace('-', ' '), color['hex'])
+                if sort:
+                    c.lab = self._named_color_lab(name)
+                colors.append(c)
+
             return self._sorted_color_image(colors)
 
         await ctx.trigger_typing()
@@ -1073,6 +1282,7 @@ class Colors(Cog):
                 return await ctx.send(f'This color already exists. Conflicting color {r.name} `{r.role_id}`')
             else:
                 self._colors.get(guild.id, {}).pop(k, None)
+                self._invalidate_colors(guild.id)
 
         color = lab
 
@@ -1102,6 +1312,7 @@ class Colors(Cog):
         else:
             self._colors[guild.id] = {color_role.id: color_}
 
+        self._invalidate_colors(guild.id)
         await ctx.send('Added color {} {}'.format(name, str(d_color)))
 
     @command(aliases=['rename_colour'])
@@ -1124,6 +1335,7 @@ class Colors(Cog):
 
         old_name = color.name
         color.name = new_name
+        self._invalidate_colors(guild.id)
         await self._add_color2db(color, update=True)
         await ctx.send(f"Renamed {old_name} to {new_name}")
 
@@ -1162,6 +1374,7 @@ class Colors(Cog):
                 return await ctx.send(f'This color already exists {new_color} (#{value:06X}). Conflicting color {r.name} `{r.role_id}`')
             else:
                 self._colors.get(guild.id, {}).pop(k, None)
+                self._invalidate_colors(guild.id)
 
         role = guild.get_role(color.role_id)
         if not role:
@@ -1180,6 +1393,7 @@ class Colors(Cog):
 
         color.value = value
         color.lab = lab
+        self._invalidate_colors(guild.id)
 
         await self._add_color2db(color, update=True)
         await ctx.send(f'Updated color to value {new_color} (#{value:06X})')
@@ -241,6 +241,10 @@ class CommandBlacklist(Cog):
                     await ctx.send(f'Failed to remove {type_string}')
                     return False
                 else:
+                    self.bot.blacklist_cache.remove_perm(values['guild'], values.get('command'),
+                                                         uid=values.get('uid'),
+                                                         role=values.get('role'),
+                                                         channel=values.get('channel'))
                     return
             else:
                 sql = 'UPDATE command_blacklist SET type=$1 WHERE id=$2'
@@ -251,6 +255,7 @@ class CommandBlacklist(Cog):
                     await ctx.send(f'Failed to remove {type_string}')
                     return False
                 else:
+                    self._cache_perm(type_, values)
                     return True
         else:
             # Dynamically create a insert that looks like this
@@ -275,8 +280,16 @@ class CommandBlacklist(Cog):
                 await ctx.send(f'Failed to set {type_string}')
                 return False
 
+            self._cache_perm(type_, values)
+
         return True
 
+    def _cache_perm(self, type_, values):
+        self.bot.blacklist_cache.set_perm(values['guild'], values.get('command'), type_,
+                                          uid=values.get('uid'),
+                                          role=values.get('role'),
+                                          channel=values.get('channel'))
+
     async def _add_user_blacklist(self, ctx, command_name, user, guild):
         whereclause = 'guild=$1 AND command=$2 AND uid=$3 AND NOT type=$4'
         success = await self._set_blacklist(ctx, whereclause, guild=guild.id,
@@ -1,4 +1,5 @@
 import asyncio
+from datetime import datetime
 
 import disnake
 from disnake.ext import tasks
@@ -7,32 +8,11 @@ from cogs.cog import Cog
 from utils.utilities import utcnow
 
 
-class UserSeen:
-    def __init__(self, user, guild_id=None):
-        self.user_id = user.id
-        self.username = str(user)
-        self.guild_id = 0 if guild_id is None else guild_id
-        self.timestamp = utcnow()
-
-    def __hash__(self):
-        return hash(self.user_id)
-
-    def __eq__(self, other):
-        # Called when adding one of this object to a set
-        # set compares the item already in it to the item being added
-        # It does not however replace on duplicate
-        # This is why we have to modify the object ourselves in case newer data is present
-        eq = self.user_id == other.user_id and self.guild_id == other.guild_id
-        if eq:
-            self.timestamp = other.timestamp
-
-        return eq
-
-
 class LastSeen(Cog):
     def __init__(self, bot):
         super().__init__(bot)
-        self._updates = set()
+        # (user_id, guild_id) -> (username, timestamp)
+        self._updates: dict[tuple[int, int], tuple[str, datetime]] = {}
         self._update_task = bot.loop.create_task(self._status_loop(), name='update_last_seen')
         self._update_now = asyncio.Event()
 
@@ -47,22 +27,23 @@ class LastSeen(Cog):
             return
 
         updates = self._updates
-        self._updates = set()
+        self._updates = {}
         user_ids = []
         guild_ids = []
         times = []
         usernames = []
-        for update in updates:
+        for (user_id, guild_id), (username, timestamp) in updates.items():
             # Ignore users who have set do not track
-            if not self.bot.can_track(update.user_id):
+            if not self.bot.can_track(user_id):
                 continue
 
-            user_ids.append(update.user_id)
-            usernames.append(update.username)
-            guild_ids.append(update.guild_id)
-            times.append(update.timestamp)
-        await self.bot.dbutils.multiple_last_seen(user_ids, usernames, guild_ids, times)
-        del updates
+            user_ids.append(user_id)
+            usernames.append(username)
+            guild_ids.append(guild_id)
+            times.append(timestamp)
+
+        if user_ids:
+            await self.bot.dbutils.multiple_last_seen(user_ids, usernames, guild_ids, times)
 
     @tasks.loop(minutes=2)
     async def _check_loop(self):
@@ -107,29 +88,24 @@ class LastSeen(Cog):
         else:
             return user.guild.id
 
+    def add_update(self, user, guild_id=None):
+        self._updates[(user.id, 0 if guild_id is None else guild_id)] = (str(user), utcnow())
+
     @Cog.listener()
     async def on_message(self, message):
-        guild = self.get_guild(message.author)
-        o = UserSeen(message.author, guild)
-        self._updates.add(o)
+        self.add_update(message.author, self.get_guild(message.author))
 
     @Cog.listener()
     async def on_reaction_add(self, _, user):
-        guild = self.get_guild(user)
-        o = UserSeen(user, guild)
-        self._updates.add(o)
+        self.add_update(user, self.get_guild(user))
 
     @Cog.listener()
     async def on_member_join(self, user):
-        guild = user.guild.id
-        o = UserSeen(user, guild)
-        self._updates.add(o)
+        self.add_update(user, user.guild.id)
 
     @Cog.listener()
     async def on_member_leave(self, user):
-        guild = user.guild.id
-        o = UserSeen(user, guild)
-        self._updates.add(o)
+        self.add_update(user, user.guild.id)
 
 
 def setup(bot):
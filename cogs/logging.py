@@ -5,6 +5,7 @@ from datetime import timedelta
 import disnake
 from disnake.abc import PrivateChannel
 
+from bot.writebehind import MessageIngestor
 from cogs.cog import Cog
 from enums.data_enums import RedisKeyNamespaces
 from utils.utilities import (split_string, format_on_delete, format_on_edit,
@@ -22,6 +23,14 @@ day = timedelta(days=1)
 class Logger(Cog):
     def __init__(self, bot):
         super().__init__(bot)
+        self._message_ingestor = MessageIngestor(bot)
+        self._message_ingestor.start()
+        # The last batch must be written before the pool is closed on shutdown
+        bot.add_close_hook('message_ingestor', self._message_ingestor.close)
+
+    def cog_unload(self):
+        self.bot.remove_close_hook('message_ingestor')
+        self.bot.loop.create_task(self._message_ingestor.close())
 
     @property
     def bot(self) -> 'NotABot':
@@ -60,26 +69,11 @@ class Logger(Cog):
         if not message.raw_role_mentions:
             return
 
-        roles = []
         guild = message.guild
         for role_id in set(message.raw_role_mentions):
             role = guild.get_role(role_id)
             if role:
-                roles.append(role)
-
-        if not roles:
-            return
-
-        sql = 'INSERT INTO mention_stats AS ms (guild, role, role_name) ' \
-              'VALUES %s' % self.bot.dbutil.create_bind_groups(len(roles), 3)
-
-        data = []
-        for role in roles:
-            data.extend((guild.id, role.id, role.name))
-
-        sql = sql.rstrip(',')
-        sql += ' ON CONFLICT (guild, role) DO UPDATE SET amount=ms.amount+1, role_name=EXCLUDED.role_name'
-        await self.bot.dbutil.execute(sql, data)
+                self.bot.mention_stats.add(guild.id, role.id, role.name)
 
     @Cog.listener()
     async def on_message(self, message):
@@ -87,10 +81,7 @@ class Logger(Cog):
         d, attachment = self.format_for_db(message)
 
         if message.guild and message.guild.id in (217677285442977792,475623556164878347) and self.bot.can_track(message.author):
-            sql = "INSERT INTO messages (guild, channel, user_id, message_id) " \
-                  "VALUES ($1, $2, $3, $4)"
-
-            await self.bot.dbutil.execute(sql, d)
+            self._message_ingestor.add(*d)
 
         # Channel index is 1
         if self.bot.redis and attachment and d[1] and self.bot.can_track(message.author):
@@ -257,9 +248,9 @@ class Logger(Cog):
         entries = list(reversed(entries))
         entries.append(cmd.name)
         guild = ctx.guild.id if ctx.guild else None
-        await self.bot.dbutil.command_used(entries[0], ' '.join(entries[1:]) or "",
-                                           ctx.message.created_at, ctx.author.id,
-                                           guild)
+        self.bot.command_recorder.record(entries[0], ' '.join(entries[1:]) or "",
+                                         ctx.message.created_at, ctx.author.id,
+                                         guild)
 
 
 def setup(bot):
@@ -8,18 +8,19 @@ from typing import Union, List, Optional, cast
 
 import disnake
 from asyncpg.exceptions import PostgresError
-from disnake.ext import tasks
 from disnake.ext.commands import (BucketType, Greedy, cooldown, guild_only,
                                   NoPrivateMessage)
 
 from bot.bot import (command, group, has_permissions,
                      bot_has_permissions, Context)
 from bot.converters import MentionedMember, PossibleUser, TimeDelta
+from bot.dbutil import Workload
+from bot.expiringevents import ExpiringEventQueue
 from bot.formatter import EmbedPaginator, EmbedLimits
 from bot.globals import DATA
 from bot.paginator import Paginator
 from cogs.cog import Cog
-from utils.utilities import (call_later, parse_timeout,
+from utils.utilities import (parse_timeout,
                              get_avatar, is_image_url,
                              seconds2str, get_channel, Snowflake, basic_check,
                              sql2timedelta, check_botperm, format_timedelta,
@@ -36,28 +37,21 @@ class Moderator(Cog):
     def __init__(self, bot):
         super().__init__(bot)
         self.timeouts = self.bot.timeouts
-        self.temproles = self.bot.temproles
         self.automute_blacklist = {}
         self.automute_whitelist = {}
         self._current_rolls = {}  # Users currently active in a mute roll
-        # Delay used to update expiring events. 30min
-        self._pause = 1800
+        self.expiring_events = ExpiringEventQueue(self.bot, self.untimeout, self.remove_role)
 
     async def cog_load(self):
         await super().cog_load()
         await self._load_automute()
+        await self._load_timeouts()
+        # on_ready isn't called again when the cog is reloaded
+        if self.bot.is_ready():
+            self.expiring_events.start()
 
     def cog_unload(self):
-        self.load_expiring_events.cancel()
-
-        for timeouts in list(self.timeouts.values()):
-            for timeout in list(timeouts.values()):
-                timeout.cancel()
-
-        for guild_temproles in list(self.temproles.values()):
-            for user_temproles in list(guild_temproles.values()):
-                for temprole in list(user_temproles.values()):
-                    temprole.cancel()
+        self.expiring_events.stop()
 
     async def cog_check(self, ctx: Context) -> bool:
         if ctx.guild is None:
@@ -66,8 +60,19 @@ class Moderator(Cog):
 
     @Cog.listener()
     async def on_ready(self):
-        if not self.load_expiring_events.is_running():
-            self.load_expiring_events.start()
+        if not self.expiring_events.started:
+            self.expiring_events.start()
+
+    async def _load_timeouts(self):
+        """Cache active timeouts so checks for muted users don't need a query"""
+        try:
+            rows = await self.bot.dbutil.get_timeouts()
+        except PostgresError:
+            logger.exception('Failed to load timeouts')
+            return
+
+        for row in rows:
+            self.get_timeouts(row['guild'])[row['uid']] = row['expires_on']
 
     async def _load_automute(self):
         sql = 'SELECT * FROM automute_blacklist'
@@ -97,38 +102,6 @@ class Moderator(Cog):
 
             s.add(row['role'])
 
-    @tasks.loop(minutes=30)
-    async def load_expiring_events(self):
-        # Load events that expire in an hour
-        expiry = timedelta(hours=1)
-        self._pause = expiry.total_seconds()//2
-        await self._load_timeouts(expiry)
-        await self._load_temproles(expiry)
-
-    async def _load_temproles(self, expires_in: timedelta):
-        date = utcnow() + expires_in
-        sql = 'SELECT * FROM temproles WHERE expires_at < $1'
-        rows = await self.bot.dbutil.fetch(sql, (date,))
-
-        for row in rows:
-            time = row['expires_at'] - utcnow()
-            guild = row['guild']
-            user = row['uid']
-            role = row['role']
-
-            self.register_temprole(user, role, guild, time.total_seconds(), ignore_dupe=True)
-
-    async def _load_timeouts(self, expires_in: timedelta):
-        date = utcnow() + expires_in
-        sql = 'SELECT * FROM timeouts WHERE expires_on < $1'
-        rows = await self.bot.dbutil.fetch(sql, (date,))
-        for row in rows:
-            time = row['expires_on'] - utcnow()
-            guild = row['guild']
-            user = row['uid']
-
-            self.register_timeout(user, guild, time.total_seconds(), ignore_dupe=True)
-
     async def send_to_modlog(self, guild, *args, **kwargs):
         if isinstance(guild, int):
             guild = self.bot.get_guild(guild)
@@ -454,7 +427,6 @@ class Moderator(Cog):
 
         guild = ctx.guild
         reason = reason if reason else 'No reason <:HYPERKINGCRIMSONANGRY:356798314752245762>'
-        guild_timeouts = self.timeouts.get(guild.id, {})
         muted_users = []
         failed = []
 
@@ -478,9 +450,6 @@ class Moderator(Cog):
                 failed.append(f'Could not mute user {user}')
                 continue
 
-            task = guild_timeouts.get(user.id)
-            if task:
-                task.cancel()
             await self.remove_timeout(user.id, guild.id)
 
         author = ctx.author
@@ -664,6 +633,7 @@ class Moderator(Cog):
         """
 
         logger.debug(f'Removing timeout of {user_id} in guild {guild_id}')
+        self.timeouts.get(guild_id, {}).pop(user_id, None)
         try:
             if return_info:
                 sql = 'DELETE FROM timeouts t USING timeout_logs tl ' \
@@ -700,7 +670,7 @@ class Moderator(Cog):
             user_ids = (user_ids, )
 
         for user_id in user_ids:
-            self.register_timeout(user_id, guild_id, as_seconds)
+            self.register_timeout(user_id, guild_id, expires_on)
 
         return True
 
@@ -1073,10 +1043,6 @@ class Moderator(Cog):
                 embed.set_footer(text=str(author), icon_url=author.display_avatar.url)
                 await self.send_to_modlog(guild, embed=embed)
 
-            t = self.timeouts.get(guild.id, {}).get(user.id)
-            if t:
-                t.cancel()
-
             await ctx.send('Unmuted user {}'.format(user))
 
     async def _unmute_when(self, ctx, user, embed=True):
@@ -1328,7 +1294,7 @@ class Moderator(Cog):
 
         sql += 'ORDER BY message_id DESC LIMIT %s' % max_messages
 
-        rows = await self.bot.dbutil.fetch(sql)
+        rows = await self.bot.dbutil.fetch(sql, workload=Workload.ANALYTICS)
 
         if not rows:
             channel = ctx.channel
@@ -1566,22 +1532,6 @@ class Moderator(Cog):
         """Set send_messages permission override on current channel to default position"""
         await self._set_channel_lock(ctx, False, zawarudo=ctx.invoked_with == 'tokiwougokidasu')
 
-    def get_temproles(self, guild: int, uid: int = None):
-        temproles = self.temproles.get(guild, None)
-        if temproles is None:
-            temproles = {}
-            self.temproles[guild] = temproles
-
-        if uid is None:
-            return temproles
-
-        user_temp = temproles.get(uid)
-        if not user_temp:
-            user_temp = {}
-            temproles[uid] = user_temp
-
-        return user_temp
-
     def get_timeouts(self, guild: int):
         timeouts = self.timeouts.get(guild, None)
         if timeouts is None:
@@ -1620,45 +1570,10 @@ class Moderator(Cog):
 
         await self.bot.dbutil.remove_temprole(user, role)
 
-    def register_timeout(self, user: int, guild: int, time, ignore_dupe=False):
-        timeouts = self.get_timeouts(guild)
-        if ignore_dupe and user in timeouts:
-            return
-
-        t = timeouts.pop(user, None)
-        if t:
-            t.cancel()
-
-        # If we modify an existing timeout to a longer one this will trigger
-        if not ignore_dupe and time > self._pause*2:
-            return
-
-        if time <= 1:
-            time = 1
-
-        task = call_later(self.untimeout, self.bot.loop, time,
-                          user, guild, after=lambda f: timeouts.pop(user, None))
-        timeouts[user] = task
-
-    def register_temprole(self, user: int, role: int, guild: int, time, ignore_dupe=False, force_save=False):
-        temproles = self.get_temproles(guild, user)
-        if role in temproles and ignore_dupe:
-            return
-
-        old = temproles.pop(role, None)
-        if old:
-            old.cancel()
-
-        if not force_save and not ignore_dupe and time > self._pause * 2:
-            return
-
-        if time <= 1:
-            time = 1
-
-        task = call_later(self.remove_role, self.bot.loop, time,
-                          user, role, guild, after=lambda _: temproles.pop(role, None))
-
-        temproles[role] = task
+    def register_timeout(self, user: int, guild: int, expires_on):
+        """Keep track of a timeout that has been saved to the database"""
+        self.get_timeouts(guild)[user] = expires_on
+        self.expiring_events.notify(expires_on)
 
     @command(cooldown_after_parsing=True)
     @cooldown(1, 5, BucketType.user)
@@ -1707,9 +1622,9 @@ class Moderator(Cog):
 
         expires_at = utcnow() + time
 
-        self.register_temprole(user.id, role.id, user.guild.id, total_seconds)
         await self.bot.dbutil.add_temprole(user.id, role.id, user.guild.id,
                                            expires_at)
+        self.expiring_events.notify(expires_at)
 
         try:
             await user.add_roles(role, reason=f'{ctx.author} temprole {seconds2str(total_seconds, long_def=False)}')
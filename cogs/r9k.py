@@ -1,4 +1,5 @@
 import asyncio
+import hashlib
 import logging
 import re
 from asyncio import Queue, QueueEmpty
@@ -58,6 +59,91 @@ class DeleteQueue:
             await ch.delete_messages(msgs)
 
 
+class R9KFilter:
+    """
+    Keeps digests of every message seen in memory so checking for
+    duplicates doesn't require a database query. New digests are written
+    to the r9k_digests table in batches.
+    """
+    DIGEST_SIZE = 16
+
+    def __init__(self, bot, seconds=5, load_timeout=5, retry_delay=60):
+        """
+        Args:
+            bot: The bot instance
+            seconds: How often new digests are written to the database
+            load_timeout: How long messages wait for the digests to load before they're let through unchecked
+            retry_delay: Seconds to wait before retrying a failed load
+        """
+        self._bot = bot
+        self._seen: set[bytes] = set()
+        self._pending: list[bytes] = []
+        self._loaded = asyncio.Event()
+        self.load_timeout = load_timeout
+        self.retry_delay = retry_delay
+        self._write_task = Loop(self._write_pending, seconds=seconds,
+                                minutes=0, hours=0,
+                                reconnect=True, count=None, loop=bot.loop)
+
+    @classmethod
+    def digest(cls, content: str) -> bytes:
+        # All values are compared in lowercase
+        return hashlib.sha256(content.lower().encode('utf-8')).digest()[:cls.DIGEST_SIZE]
+
+    async def start(self):
+        self._write_task.start()
+        while True:
+            try:
+                converted = await self._bot.dbutil.convert_legacy_r9k(self.digest)
+                if converted:
+                    logger.info(f'Converted {converted} r9k messages to digests')
+
+                rows = await self._bot.dbutil.fetch('SELECT digest FROM r9k_digests')
+                break
+            except Exception:
+                logger.exception(f'Failed to load r9k digests. Retrying in {self.retry_delay} seconds')
+                await asyncio.sleep(self.retry_delay)
+
+        # Messages might have been added while loading
+        self._seen.update(row['digest'] for row in rows)
+        self._loaded.set()
+
+    async def stop(self):
+        self._write_task.cancel()
+        await self._write_pending()
+
+    async def check(self, content: str) -> bool:
+        """
+        Returns True if the content hasn't been seen before and marks it as seen
+        """
+        if not self._loaded.is_set():
+            try:
+                await asyncio.wait_for(self._loaded.wait(), timeout=self.load_timeout)
+            except asyncio.TimeoutError:
+                # Let messages through instead of piling them up while the database is unavailable.
+                # They are still recorded so later duplicates of them are caught
+                pass
+
+        digest = self.digest(content)
+        if digest in self._seen:
+            return False
+
+        self._seen.add(digest)
+        self._pending.append(digest)
+        return True
+
+    async def _write_pending(self):
+        if not self._pending:
+            return
+
+        digests, self._pending = self._pending, []
+        try:
+            await self._bot.dbutil.add_r9k_digests(digests)
+        except Exception:
+            logger.exception('Failed to save r9k digests')
+            self._pending = digests + self._pending
+
+
 class R9K(Cog):
     def __init__(self, bot):
         super().__init__(bot)
@@ -67,6 +153,10 @@ class R9K(Cog):
         self._delete_queue = DeleteQueue(bot.loop)
         # We Loop.start uses a non thread-safe operation so we need to run it thread-safe
         asyncio.run_coroutine_threadsafe(self._delete_queue.start(), loop=bot.loop).result()
+        self._filter = R9KFilter(bot)
+        self._filter_task = bot.loop.create_task(self._filter.start())
+        # Pending digests must be written before the pool is closed on shutdown
+        bot.add_close_hook('r9k', self._filter.stop)
 
     def cog_unload(self):
         try:
@@ -74,6 +164,10 @@ class R9K(Cog):
         except asyncio.TimeoutError:
             pass
 
+        self._filter_task.cancel()
+        self.bot.remove_close_hook('r9k')
+        self.bot.loop.create_task(self._filter.stop())
+
     @Cog.listener()
     async def on_message(self, msg):
         guild = msg.guild
@@ -100,10 +194,7 @@ class R9K(Cog):
         content = content.replace('\u200d', '').replace('\u200b', '').replace('  ', ' ')
         content = content.strip(' \n_*`\'"´~')
 
-        # All values will be indexed in lowercase
-        sql = 'INSERT INTO r9k (message) VALUES ($1) ON CONFLICT DO NOTHING RETURNING 1'
-        row = await self.bot.dbutil.fetch(sql, (content,), fetchmany=False)
-        if row is None:
+        if not await self._filter.check(content):
             self._delete_queue.put(msg)
             if not self._cooldown.valid:
                 return
@@ -1,4 +1,3 @@
-import asyncio
 import datetime
 import logging
 import ntpath
@@ -1128,18 +1127,26 @@ class Server(Cog[NotABot]):
 
         await self.rotate_banner(guild)
 
+    def _schedule_rotate(self, calls: dict, key: str, delay_start: dtime, delay: timedelta,
+                         guild_id: int, rotate):
+        async def method():
+            await rotate(guild_id)
+            self._schedule_rotate(calls, key, delay_start, delay, guild_id, rotate)
+
+        timeout = get_next_rotate_run_time(delay_start, delay)
+        # Don't rotate twice if the call was run right before the scheduled time
+        if timeout < 1:
+            timeout += delay.total_seconds()
+
+        calls[guild_id] = self.bot.scheduler.schedule((key, guild_id), timeout, method)
+
     def load_guild_rotate(self, delay_start: dtime, delay: timedelta, guild_id: int):
         old_task = self.bot.banner_rotate.get(guild_id)
         if old_task and not old_task.done():
             return
 
-        async def method():
-            while True:
-                await asyncio.sleep(get_next_rotate_run_time(delay_start, delay))
-                await self.do_guild_banner_rotate(guild_id)
-
-        task = asyncio.run_coroutine_threadsafe(method(), self.bot.loop)
-        self.bot.banner_rotate[guild_id] = task
+        self._schedule_rotate(self.bot.banner_rotate, 'banner_rotate', delay_start, delay,
+                              guild_id, self.do_guild_banner_rotate)
 
     @group(aliases=['brotate'], invoke_without_command=True)
     @guild_has_features('BANNER')
@@ -1245,7 +1252,7 @@ class Server(Cog[NotABot]):
             task.cancel()
             self.bot.banner_rotate.pop(ctx.guild.id, None)
 
-        self.load_guild_rotate(timeout, ctx.guild.id)
+        self.load_guild_rotate(t, delay, ctx.guild.id)
         await ctx.send(f'Next automatic banner rotation {native_format_timedelta(timedelta(seconds=timeout))}')
 
     # endregion banners
@@ -1301,14 +1308,8 @@ class Server(Cog[NotABot]):
         if old_task and not old_task.done():
             return
 
-        async def method():
-            while True:
-                await asyncio.sleep(get_next_rotate_run_time(delay_start, delay))
-                await self.do_guild_icon_rotate(guild_id)
-
-        task = asyncio.run_coroutine_threadsafe(method(), self.bot.loop)
-
-        self.bot.icon_rotate[guild_id] = task
+        self._schedule_rotate(self.bot.icon_rotate, 'icon_rotate', delay_start, delay,
+                              guild_id, self.do_guild_icon_rotate)
 
     @slash_command(name='rotate-icon-management',
                    contexts=InteractionContextTypes(guild=True),
@@ -1618,7 +1619,7 @@ class Server(Cog[NotABot]):
             task.cancel()
             self.bot.icon_rotate.pop(ctx.guild.id, None)
 
-        self.load_icon_rotate(timeout, delay.total_seconds(), ctx.guild.id)
+        self.load_icon_rotate(t, delay, ctx.guild.id)
         await ctx.send(f'Next automatic icon rotation {native_format_timedelta(timedelta(seconds=timeout))}')
 
     # endregion server icons
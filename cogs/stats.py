@@ -8,6 +8,7 @@ from disnake.ext.commands import BucketType, cooldown, guild_only
 
 from bot.bot import command, bot_has_permissions, group, Group
 from bot.converters import AnyUser, CommandConverter, TimeDelta
+from bot.dbutil import Workload
 from bot.paginator import Paginator
 from cogs.cog import Cog
 from utils.utilities import format_timedelta, DateAccuracy, utcnow
@@ -44,8 +45,18 @@ class Stats(Cog):
         else:
             page = 1
 
-        sql = 'SELECT * FROM mention_stats WHERE guild={} ORDER BY amount DESC LIMIT {}'.format(guild.id, 10*page)
-        rows = await self.bot.dbutil.fetch(sql)
+        sql = 'SELECT role, role_name, amount FROM mention_stats WHERE guild=$1'
+        rows = {row['role']: dict(row) for row in await self.bot.dbutil.fetch(sql, (guild.id,))}
+
+        # Merge mentions that haven't been written to the db yet
+        for role_id, (amount, role_name) in self.bot.mention_stats.pending(guild.id).items():
+            row = rows.get(role_id)
+            if row is None:
+                rows[role_id] = {'role': role_id, 'role_name': role_name, 'amount': amount}
+            else:
+                row['amount'] += amount
+
+        rows = sorted(rows.values(), key=lambda r: r['amount'], reverse=True)
         if not rows:
             return await ctx.send('No role mentions logged on this server')
 
@@ -101,7 +112,7 @@ class Stats(Cog):
             sql = 'SELECT * FROM last_seen_users WHERE guild=$2 AND %s' % user_clause
 
         try:
-            rows = await self.bot.dbutil.fetch(sql, (user_id, guild))
+            rows = await self.bot.dbutil.fetch(sql, (user_id, guild), workload=Workload.ANALYTICS)
         except PostgresError:
             logger.exception('Failed to get last seen from db')
             return await ctx.send('Failed to get user because of an error')
@@ -3,10 +3,13 @@ import asyncio
 import logging
 import operator
 import re
+from datetime import datetime
+from typing import Optional
 
 import disnake
 import numpy
 from asyncpg.exceptions import PostgresError
+from disnake.ext import tasks
 from disnake.ext.commands import BucketType, cooldown, is_owner, guild_only
 from emoji import emoji_count
 
@@ -107,10 +110,13 @@ class Poll:
     def __init__(self, bot, message, channel, title, expires_at=None,
                  strict=False, emotes=None, no_duplicate_votes=False,
                  multiple_votes=False, max_winners=1, after=None,
-                 giveaway: bool=False, allow_n_votes=None):
+                 giveaway: bool=False, allow_n_votes=None, reconciled=True):
         """
         Args:
             message: either `class`: disnake.Message or int
+            reconciled: False if votes might've been missed, e.g. when the poll
+                        was restored after a restart. All reactions are then
+                        fetched from the api once when the poll is counted
             others explained in VoteManager
         """
         self._bot = bot
@@ -124,10 +130,13 @@ class Poll:
         self.multiple_votes = multiple_votes
         self.max_winners = max_winners
         self.giveaway = giveaway
-        self._task = None
-        self._stopper = asyncio.Event()
+        self._call = None
         self._after = after
         self.allow_n_votes = allow_n_votes
+        # Live tally kept up to date from reaction events. {emote: {user_id: is_bot}}
+        # Reactions of the bot itself aren't included
+        self._votes: dict[str, dict[int, bool]] = {}
+        self._reconciled = reconciled
 
     @property
     def bot(self):
@@ -137,36 +146,108 @@ class Poll:
         # Used when recreating the poll
         self._emotes.append(emote_id)
 
+    def add_vote(self, emote: str, user_id: int, is_bot: bool) -> bool:
+        """
+        Add a reaction to the live tally
+
+        Returns:
+            Whether the tally changed
+        """
+        users = self._votes.get(emote)
+        if users is None:
+            users = {}
+            self._votes[emote] = users
+        elif user_id in users:
+            return False
+
+        users[user_id] = is_bot
+        return True
+
+    def remove_vote(self, emote: str, user_id: int) -> bool:
+        """
+        Remove a reaction from the live tally
+
+        Returns:
+            Whether the tally changed
+        """
+        users = self._votes.get(emote)
+        if not users or user_id not in users:
+            return False
+
+        del users[user_id]
+        if not users:
+            self._votes.pop(emote, None)
+        return True
+
+    def clear_votes(self, emote: str = None) -> dict[str, dict[int, bool]]:
+        """Remove all votes or the votes of one emote. Returns the removed votes"""
+        if emote is None:
+            votes, self._votes = self._votes, {}
+            return votes
+
+        users = self._votes.pop(emote, None)
+        return {emote: users} if users else {}
+
+    async def _get_reaction_users(self, msg: disnake.Message) -> list[tuple[str, str, list[int]]]:
+        """
+        Get the voters of every reaction on the message.
+        Voters are taken from the live tally once it has been reconciled with the api.
+        Polls that weren't reconciled yet and reactions where the amount of users
+        doesn't match the tally are fetched from the api and the tally is fixed.
+
+        Returns:
+            List of (emote, emote id used in strict mode, list of user ids) in the
+            same order as the reactions on the message
+        """
+        reactions = []
+        bot_id = self.bot.user.id
+        reconcile = not self._reconciled
+        if reconcile:
+            # Drop votes of reactions that were cleared while offline
+            self._votes = {}
+
+        for reaction in msg.reactions:
+            emote = str(reaction.emoji)
+            users = self._votes.get(emote)
+            if reconcile or users is None or len(users) != reaction.count - reaction.me:
+                users = {}
+                async for user in reaction.users(limit=reaction.count):
+                    if user.id != bot_id:
+                        users[user.id] = user.bot
+                self._votes[emote] = users
+
+            id_ = reaction.emoji if isinstance(reaction.emoji, str) else str(reaction.emoji.id)
+            reactions.append((emote, id_, [uid for uid, is_bot in users.items() if not is_bot]))
+
+        self._reconciled = True
+        return reactions
+
+    @property
+    def _key(self):
+        msg_id = self.message.id if isinstance(self.message, disnake.Message) else self.message
+        return 'poll', msg_id
+
+    def _schedule(self, delay: float):
+        self._call = self.bot.scheduler.schedule(self._key, delay, self.count_votes,
+                                                 after=self._after)
+
     def start(self):
-        self._stopper.clear()
-        self._task = asyncio.run_coroutine_threadsafe(self._wait(), loop=self.bot.loop)
-        if callable(self._after):
-            self._task.add_done_callback(self._after)
+        delay = 0
+        if self.expires_at is not None:
+            delay = (self.expires_at - utcnow()).total_seconds()
+
+        self._schedule(delay)
 
     def stop(self):
-        if self._task:
-            self._task.cancel()
+        if self._call:
+            self._call.cancel()
 
     def count_now(self):
-        self._stopper.set()
-
-    async def _wait(self):
-        try:
-            if self.expires_at is not None:
-                time_ = self.expires_at - utcnow()
-                time_ = time_.total_seconds()
-                if time_ > 0:
-                    await asyncio.wait_for(self._stopper.wait(), timeout=time_)
-        except asyncio.TimeoutError:
-            pass
-        except asyncio.CancelledError:
-            return
+        if self._call:
+            # The poll isn't finished so the replaced call shouldn't run the after callback
+            self._call.after = None
 
-        try:
-            await self.count_votes()
-        except:
-            logger.exception('Failed to count votes')
-            raise
+        self._schedule(0)
 
     async def count_votes(self):
         if isinstance(self.message, disnake.Message):
@@ -189,26 +270,21 @@ class Poll:
             return await channel.send('Failed to end poll.\nReason: Could not get the poll message')
 
         votes = {}
-        for reaction in msg.reactions:
-            if self.strict:
-                id = reaction.emoji if isinstance(reaction.emoji, str) else str(reaction.emoji.id)
-                if id not in self._emotes:
-                    continue
+        for emote, id_, users in await self._get_reaction_users(msg):
+            if self.strict and id_ not in self._emotes:
+                continue
 
-            async for user in reaction.users(limit=reaction.count):
-                if user.bot:
-                    continue
-
-                if self.ignore_on_dupe and user.id in votes:
-                    votes[user.id] = None
+            for uid in users:
+                if self.ignore_on_dupe and uid in votes:
+                    votes[uid] = None
                 elif not self.multiple_votes:
-                    votes[user.id] = [str(reaction.emoji)]
+                    votes[uid] = [emote]
                 else:
-                    if user.id in votes:
-                        if self.allow_n_votes is None or len(votes[user.id]) < self.allow_n_votes:
-                            votes[user.id] += (str(reaction.emoji), )
+                    if uid in votes:
+                        if self.allow_n_votes is None or len(votes[uid]) < self.allow_n_votes:
+                            votes[uid] += (emote, )
                     else:
-                        votes[user.id] = [str(reaction.emoji)]
+                        votes[uid] = [emote]
 
         if self.giveaway:
             users = list(votes.keys())
@@ -307,11 +383,88 @@ class VoteManager(Cog):
         self.parser.add_argument('-no_duplicate_votes', action='store_true')
         self.parser.add_argument('-allow_multiple_entries', action='store_true')
         self.parser.add_argument('-giveaway', action='store_true')
+        # Vote changes waiting to be saved.
+        # {(poll_id, emote, user_id): (is_bot, voted_at) or None if the vote was removed}
+        self._vote_changes: dict[tuple[int, str, int], Optional[tuple[bool, datetime]]] = {}
+
+    async def cog_load(self):
+        await super().cog_load()
+        self._save_votes_loop.start()
+        # Make sure the last votes are saved before the pool is closed on shutdown
+        self.bot.add_close_hook('poll_votes', self.save_votes)
+
+    def cog_unload(self):
+        self._save_votes_loop.cancel()
+        self.bot.remove_close_hook('poll_votes')
+        asyncio.create_task(self.save_votes())
 
     def __unload(self):
         for poll in list(self.polls.values()):
             poll.stop()
 
+    async def save_votes(self):
+        if not self._vote_changes:
+            return
+
+        changes, self._vote_changes = self._vote_changes, {}
+        added = [(*key, *value) for key, value in changes.items() if value is not None]
+        removed = [key for key, value in changes.items() if value is None]
+
+        try:
+            await self.bot.dbutil.update_poll_votes(added, removed)
+        except Exception:
+            logger.exception('Failed to save poll votes')
+            # Changes made during the save are newer
+            changes.update(self._vote_changes)
+            self._vote_changes = changes
+
+    @tasks.loop(seconds=30)
+    async def _save_votes_loop(self):
+        await self.save_votes()
+
+    def _votes_removed(self, poll_id: int, votes: dict[str, dict[int, bool]]):
+        for emote, users in votes.items():
+            for uid in users:
+                self._vote_changes[(poll_id, emote, uid)] = None
+
+    @Cog.listener()
+    async def on_raw_reaction_add(self, payload: disnake.RawReactionActionEvent):
+        poll = self.polls.get(payload.message_id)
+        if poll is None or payload.user_id == self.bot.user.id:
+            return
+
+        if payload.member is not None:
+            is_bot = payload.member.bot
+        else:
+            user = self.bot.get_user(payload.user_id)
+            is_bot = user.bot if user else False
+
+        emote = str(payload.emoji)
+        if poll.add_vote(emote, payload.user_id, is_bot):
+            self._vote_changes[(payload.message_id, emote, payload.user_id)] = (is_bot, utcnow())
+
+    @Cog.listener()
+    async def on_raw_reaction_remove(self, payload: disnake.RawReactionActionEvent):
+        poll = self.polls.get(payload.message_id)
+        if poll is None:
+            return
+
+        emote = str(payload.emoji)
+        if poll.remove_vote(emote, payload.user_id):
+            self._vote_changes[(payload.message_id, emote, payload.user_id)] = None
+
+    @Cog.listener()
+    async def on_raw_reaction_clear(self, payload: disnake.RawReactionClearEvent):
+        poll = self.polls.get(payload.message_id)
+        if poll is not None:
+            self._votes_removed(payload.message_id, poll.clear_votes())
+
+    @Cog.listener()
+    async def on_raw_reaction_clear_emoji(self, payload: disnake.RawReactionClearEmojiEvent):
+        poll = self.polls.get(payload.message_id)
+        if poll is not None:
+            self._votes_removed(payload.message_id, poll.clear_votes(str(payload.emoji)))
+
     async def load_polls(self):
         sql = 'SELECT polls.*, emotes.emote ' \
               'FROM polls LEFT OUTER JOIN pollemotes pe ON polls.message = pe.poll_id LEFT OUTER JOIN emotes ON emotes.emote = pe.emote_id'
@@ -324,9 +477,10 @@ class VoteManager(Cog):
                                                   no_duplicate_votes=row['ignore_on_dupe'],
                                                   multiple_votes=row['multiple_votes'],
                                                   max_winners=row['max_winners'] or 1,
-                                                  after=lambda f: self.polls.pop(row['message'], None),
+                                                  after=lambda f, msg_id=row['message']: self.polls.pop(msg_id, None),
                                                   giveaway=row['giveaway'],
-                                                  allow_n_votes=row['allow_n_votes']))
+                                                  allow_n_votes=row['allow_n_votes'],
+                                                  reconciled=False))
 
             r = self.polls.get(row['message'])
             if r:
@@ -335,6 +489,19 @@ class VoteManager(Cog):
             polls[row['message']] = poll
             poll.add_emote(row['emote'])
 
+        # Votes saved from reaction events. Votes made while the bot was offline
+        # are fixed when the poll is counted as the polls aren't reconciled yet
+        try:
+            vote_rows = await self.bot.dbutil.get_poll_votes()
+        except PostgresError:
+            logger.exception('Failed to load poll votes')
+            vote_rows = []
+
+        for row in vote_rows:
+            poll = polls.get(row['poll_id'])
+            if poll:
+                poll.add_vote(row['emote'], row['uid'], row['is_bot'])
+
         for poll in polls.values():
             self.polls[poll.message] = poll
             poll.start()
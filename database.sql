@@ -287,6 +287,16 @@ create table pollemotes
 create index idx_27247_emote_id
   on pollemotes (emote_id);
 
+CREATE TABLE poll_votes
+(
+    poll_id  BIGINT      NOT NULL REFERENCES polls (message) ON DELETE CASCADE,
+    emote    TEXT        NOT NULL,
+    uid      BIGINT      NOT NULL,
+    is_bot   BOOLEAN     NOT NULL DEFAULT FALSE,
+    voted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (poll_id, emote, uid)
+);
+
 create index idx_27250_server_id
   on polls (guild);
 
@@ -385,19 +395,27 @@ create table temproles
   uid        bigint                              not null,
   guild      bigint                              not null,
   expires_at timestamp default CURRENT_TIMESTAMP not null,
+  claimed_until timestamptz default null,
   constraint idx_27271_primary
     primary key (role, uid)
 );
 
+create index temproles_expires_at_idx
+  on temproles (expires_at);
+
 create table timeouts
 (
   guild      bigint    not null,
   uid        bigint    not null,
   expires_on timestamp not null,
+  claimed_until timestamptz default null,
   constraint idx_27274_primary
     primary key (uid, guild)
 );
 
+create index timeouts_expires_on_idx
+  on timeouts (expires_on);
+
 create table timeout_logs
 (
   guild        bigint                              not null,
@@ -466,6 +484,14 @@ create table userroles
 create index idx_27306_role_id
   on userroles (role);
 
+CREATE TABLE userroles_fingerprints
+(
+    guild       BIGINT NOT NULL,
+    uid         BIGINT NOT NULL,
+    fingerprint BIGINT NOT NULL,
+    PRIMARY KEY (guild, uid)
+);
+
 create table users
 (
   id bigint not null,
@@ -475,9 +501,9 @@ create table users
 );
 
 CREATE EXTENSION IF NOT EXISTS citext;
-CREATE TABLE r9k
+CREATE TABLE r9k_digests
 (
-    message CITEXT PRIMARY KEY
+    digest BYTEA PRIMARY KEY
 );
 
 CREATE TABLE infections (
@@ -0,0 +1,11 @@
+-- Store r9k messages as a fixed width digest instead of the full text.
+-- The digest is the first 16 bytes of sha256 of the lowercase message in utf-8
+CREATE TABLE r9k_digests
+(
+    digest BYTEA PRIMARY KEY
+);
+
+-- Postgres lower() doesn't lowercase every character the same way as python
+-- so the old messages are converted by the bot on startup. It drops this table
+-- once done.
+ALTER TABLE r9k RENAME TO r9k_legacy;
@@ -0,0 +1,9 @@
+-- Fingerprint of the role set of a member saved when keeproles is indexed.
+-- Members whose fingerprint hasn't changed are skipped on the next index
+CREATE TABLE userroles_fingerprints
+(
+    guild       BIGINT NOT NULL,
+    uid         BIGINT NOT NULL,
+    fingerprint BIGINT NOT NULL,
+    PRIMARY KEY (guild, uid)
+);
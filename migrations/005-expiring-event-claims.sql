@@ -0,0 +1,9 @@
+-- Timeouts and temproles work as a job queue for expiring events.
+-- claimed_until is set when an expired row is claimed for processing and the
+-- row is deleted once the event has been handled. If the bot dies before that
+-- the claim runs out and the row is picked up again.
+ALTER TABLE timeouts ADD COLUMN claimed_until TIMESTAMPTZ DEFAULT NULL;
+ALTER TABLE temproles ADD COLUMN claimed_until TIMESTAMPTZ DEFAULT NULL;
+
+CREATE INDEX timeouts_expires_on_idx ON timeouts (expires_on);
+CREATE INDEX temproles_expires_at_idx ON temproles (expires_at);
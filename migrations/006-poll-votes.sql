@@ -0,0 +1,11 @@
+-- Live vote tallies of active polls. Kept up to date from reaction events
+-- so polls don't have to fetch every reaction user when they end
+CREATE TABLE poll_votes
+(
+    poll_id  BIGINT      NOT NULL REFERENCES polls (message) ON DELETE CASCADE,
+    emote    TEXT        NOT NULL,
+    uid      BIGINT      NOT NULL,
+    is_bot   BOOLEAN     NOT NULL DEFAULT FALSE,
+    voted_at TIMESTAMPTZ NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (poll_id, emote, uid)
+);
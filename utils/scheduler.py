@@ -0,0 +1,281 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import weakref
+from datetime import datetime, timedelta, timezone
+from typing import Any, Callable, Optional
+
+logger = logging.getLogger('terminal')
+
+_PENDING = 0
+_RUNNING = 1
+_DONE = 2
+_CANCELLED = 3
+
+
+class ScheduledCall:
+    """
+    Handle for a call added to a Scheduler.
+    Has the same interface CallLater used to have so it can be cancelled
+    and the run time can be shown to users
+    """
+    __slots__ = ('key', 'when', 'runs_at', 'func', 'args', 'kwargs', 'after',
+                 '_scheduler', '_task', '_state')
+
+    def __init__(self, scheduler: 'Scheduler', key, when: float, runs_at: datetime,
+                 func, args, kwargs, after):
+        self._scheduler = scheduler
+        self.key = key
+        self.when = when
+        self.runs_at = runs_at
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.after = after
+        self._task: Optional[asyncio.Task] = None
+        self._state = _PENDING
+
+    def cancel(self):
+        self._scheduler.cancel_call(self)
+
+    def done(self) -> bool:
+        return self._state in (_DONE, _CANCELLED)
+
+    def cancelled(self) -> bool:
+        return self._state == _CANCELLED
+
+    def __repr__(self):
+        return f'<{self.__class__.__name__}> Runs at {self.runs_at}'
+
+
+class Scheduler:
+    """
+    Runs async functions after a delay.
+
+    All pending calls are kept in a single heap ordered by their run time
+    and only one timer handle is registered to the event loop at a time.
+    That handle always points to the earliest call, so the amount of pending
+    calls doesn't affect the amount of tasks or loop handles.
+    A task is only created once a call is due.
+
+    Calls can optionally be given a key. Scheduling a call with a key
+    that is already pending replaces the old call.
+    Cancelled calls are removed from the heap lazily.
+    """
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        self._loop = loop
+        self._heap: list[tuple[float, int, ScheduledCall]] = []
+        self._keys: dict[Any, ScheduledCall] = {}
+        self._running: set[ScheduledCall] = set()
+        self._counter = itertools.count()
+        self._handle: Optional[asyncio.TimerHandle] = None
+        self._handle_when: Optional[float] = None
+        self._cancelled = 0
+
+    @property
+    def loop(self):
+        return self._loop
+
+    def __len__(self):
+        return len(self._heap) - self._cancelled
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def get(self, key) -> Optional[ScheduledCall]:
+        return self._keys.get(key)
+
+    def _in_loop_thread(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def schedule(self, key, delay: float, func: Callable, *args,
+                 after: Callable = None, **kwargs) -> ScheduledCall:
+        """
+        Schedule func(*args, **kwargs) to be awaited after delay seconds
+
+        Args:
+            key: Hashable key for the call or None. A pending call with the same key is cancelled
+            delay: How long to wait in seconds
+            func: Async function to call
+            after: Function called with the ScheduledCall when it finishes or is cancelled
+
+        Returns:
+            ScheduledCall
+        """
+        delay = max(delay, 0)
+        call = ScheduledCall(self, key, self._loop.time() + delay,
+                             datetime.now(timezone.utc) + timedelta(seconds=delay),
+                             func, args, kwargs, after)
+
+        if self._in_loop_thread():
+            self._push(call)
+        else:
+            self._loop.call_soon_threadsafe(self._push, call)
+
+        return call
+
+    def schedule_at(self, key, when: datetime, func: Callable, *args,
+                    after: Callable = None, **kwargs) -> ScheduledCall:
+        """Same as schedule but takes an aware datetime instead of a delay"""
+        delay = (when - datetime.now(timezone.utc)).total_seconds()
+        return self.schedule(key, delay, func, *args, after=after, **kwargs)
+
+    def cancel(self, key) -> bool:
+        """
+        Cancel the pending call with the given key
+
+        Returns:
+            Whether a call was cancelled
+        """
+        call = self._keys.get(key)
+        if call is None:
+            return False
+
+        call.cancel()
+        return True
+
+    def cancel_call(self, call: ScheduledCall):
+        if not self._in_loop_thread():
+            self._loop.call_soon_threadsafe(self.cancel_call, call)
+            return
+
+        if call._state == _RUNNING:
+            call._task.cancel()
+            return
+
+        if call._state != _PENDING:
+            return
+
+        call._state = _CANCELLED
+        if call.key is not None and self._keys.get(call.key) is call:
+            del self._keys[call.key]
+
+        self._cancelled += 1
+        # Rebuild the heap if most of it is cancelled calls
+        if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+            self._heap = [e for e in self._heap if e[2]._state == _PENDING]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+        self._call_after(call)
+
+    def close(self):
+        """Cancels all pending and running calls"""
+        if self._handle:
+            self._handle.cancel()
+            self._handle = None
+            self._handle_when = None
+
+        heap, self._heap = self._heap, []
+        self._cancelled = 0
+        self._keys.clear()
+        for _, _, call in heap:
+            if call._state == _PENDING:
+                call._state = _CANCELLED
+                self._call_after(call)
+
+        for call in list(self._running):
+            call.cancel()
+
+    def _push(self, call: ScheduledCall):
+        if call._state != _PENDING:
+            # Cancelled from the loop thread before it was pushed from another thread
+            self._cancelled -= 1
+            return
+
+        if call.key is not None:
+            old = self._keys.get(call.key)
+            if old is not None:
+                old.cancel()
+            self._keys[call.key] = call
+
+        heapq.heappush(self._heap, (call.when, next(self._counter), call))
+        self._arm()
+
+    def _arm(self):
+        # Drop cancelled calls from the top so the timer isn't armed for them
+        while self._heap and self._heap[0][2]._state != _PENDING:
+            heapq.heappop(self._heap)
+            self._cancelled -= 1
+
+        if not self._heap:
+            if self._handle:
+                self._handle.cancel()
+                self._handle = None
+                self._handle_when = None
+            return
+
+        when = self._heap[0][0]
+        if self._handle and self._handle_when <= when:
+            return
+
+        if self._handle:
+            self._handle.cancel()
+
+        self._handle_when = when
+        self._handle = self._loop.call_at(when, self._dispatch)
+
+    def _dispatch(self):
+        self._handle = None
+        self._handle_when = None
+        now = self._loop.time()
+
+        while self._heap and self._heap[0][0] <= now:
+            _, _, call = heapq.heappop(self._heap)
+            if call._state != _PENDING:
+                self._cancelled -= 1
+                continue
+
+            if call.key is not None and self._keys.get(call.key) is call:
+                del self._keys[call.key]
+
+            call._state = _RUNNING
+            self._running.add(call)
+            call._task = self._loop.create_task(self._run(call))
+
+        self._arm()
+
+    async def _run(self, call: ScheduledCall):
+        try:
+            await call.func(*call.args, **call.kwargs)
+        except asyncio.CancelledError:
+            call._state = _CANCELLED
+        except Exception:
+            logger.exception(f'Failed to run scheduled call {call.func}')
+        finally:
+            if call._state == _RUNNING:
+                call._state = _DONE
+            self._running.discard(call)
+            self._call_after(call)
+
+    @staticmethod
+    def _call_after(call: ScheduledCall):
+        if not callable(call.after):
+            return
+
+        try:
+            call.after(call)
+        except Exception:
+            logger.exception('Failed to run scheduled call after callback')
+
+
+_schedulers: 'weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, Scheduler]' = weakref.WeakKeyDictionary()
+_schedulers_lock = threading.Lock()
+
+
+def get_scheduler(loop: asyncio.AbstractEventLoop) -> Scheduler:
+    """Returns the shared scheduler of the given event loop"""
+    scheduler = _schedulers.get(loop)
+    if scheduler is None:
+        with _schedulers_lock:
+            scheduler = _schedulers.get(loop)
+            if scheduler is None:
+                scheduler = Scheduler(loop)
+                _schedulers[loop] = scheduler
+
+    return scheduler
@@ -1,35 +1,145 @@
-import asyncio
+import heapq
+import time
+from collections import OrderedDict
+from collections.abc import MutableSet
+from typing import Optional
 
-from utils.utilities import call_later
 
+class TimedSet(MutableSet):
+    """
+    Set where every element expires after a ttl.
 
-class TimedSet(set):
-    def __init__(self, iterable=None, loop=None):
-        if not iterable:
-            super().__init__()
-        else:
-            super().__init__(iterable)
+    Expiry times are kept in a dict for membership checks and in a heap
+    ordered by expiry. Expired elements are purged from the top of the
+    heap whenever the set is accessed so no tasks or timers are needed.
+    If max_size is set adding to a full set removes the element closest
+    to expiring.
+    """
+    def __init__(self, iterable=None, ttl: float = 60, max_size: Optional[int] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._expires: dict = {}
+        self._heap: list[tuple[float, int, object]] = []
+        # Tiebreaker so elements themselves never need to be comparable
+        self._counter = 0
 
-        self._loop = loop
-        self._tasks = []
+        if iterable:
+            for element in iterable:
+                self.add(element)
 
-    async def _remove_element(self, element, ttl):
-        await asyncio.sleep(ttl)
-        self.discard(element)
+    def _purge(self, now: float = None):
+        now = now or time.monotonic()
+        heap = self._heap
+        expires = self._expires
+        while heap and heap[0][0] <= now:
+            expires_at, _, element = heapq.heappop(heap)
+            # The element might've been discarded and added again
+            if expires.get(element) == expires_at:
+                del expires[element]
 
-    def clear(self):
-        super().clear()
-        map(lambda t: t.cancel(), self._tasks)
+    def _pop_oldest(self):
+        while self._heap:
+            expires_at, _, element = heapq.heappop(self._heap)
+            if self._expires.get(element) == expires_at:
+                del self._expires[element]
+                return
+
+    def __contains__(self, element):
+        expires_at = self._expires.get(element)
+        return expires_at is not None and expires_at > time.monotonic()
+
+    def __iter__(self):
+        self._purge()
+        return iter(list(self._expires))
 
-    def add(self, element, ttl=60):
+    def __len__(self):
+        self._purge()
+        return len(self._expires)
+
+    def __repr__(self):
+        return f'{self.__class__.__name__}({list(self)!r})'
+
+    def add(self, element, ttl: float = None):
         """
         Add an element to the timed set.
         If element already exist won't update anything
         """
-        if element in self:
+        now = time.monotonic()
+        self._purge(now)
+        if element in self._expires:
             return
 
-        super().add(element)
-        self._tasks.append(
-            call_later(self._remove_element, self._loop, ttl, element, ttl),
-        )
+        if self.max_size is not None and len(self._expires) >= self.max_size:
+            self._pop_oldest()
+
+        expires_at = now + (ttl if ttl is not None else self.ttl)
+        self._expires[element] = expires_at
+        self._counter += 1
+        heapq.heappush(self._heap, (expires_at, self._counter, element))
+
+    def discard(self, element):
+        # The heap entry is left in place and skipped when purged
+        self._expires.pop(element, None)
+        if not self._expires:
+            self._heap.clear()
+
+    def clear(self):
+        self._expires.clear()
+        self._heap.clear()
+
+
+class TimedDict:
+    """
+    Dict where every key expires ttl seconds after it was last set.
+
+    All keys share the same ttl so insertion order is also expiry order.
+    Expired keys are purged from the front of the dict on access and
+    the oldest key is removed when max_size is exceeded.
+    """
+    def __init__(self, ttl: float = 60, max_size: Optional[int] = None):
+        self.ttl = ttl
+        self.max_size = max_size
+        # key -> (expires_at, value)
+        self._data: OrderedDict = OrderedDict()
+
+    def _purge(self, now: float):
+        data = self._data
+        while data:
+            key, (expires_at, _) = next(iter(data.items()))
+            if expires_at > now:
+                break
+            del data[key]
+
+    def __setitem__(self, key, value):
+        now = time.monotonic()
+        self._purge(now)
+        self._data.pop(key, None)
+        self._data[key] = (now + self.ttl, value)
+
+        if self.max_size is not None and len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+
+    def __getitem__(self, key):
+        self._purge(time.monotonic())
+        return self._data[key][1]
+
+    def __contains__(self, key):
+        item = self._data.get(key)
+        return item is not None and item[0] > time.monotonic()
+
+    def __len__(self):
+        self._purge(time.monotonic())
+        return len(self._data)
+
+    def get(self, key, default=None):
+        self._purge(time.monotonic())
+        item = self._data.get(key)
+        return default if item is None else item[1]
+
+    def pop(self, key, default=None):
+        self._purge(time.monotonic())
+        item = self._data.pop(key, None)
+        return default if item is None else item[1]
+
+    def clear(self):
+        self._data.clear()
@@ -0,0 +1,101 @@
+import heapq
+from typing import Iterable, Optional
+
+
+class TrigramIndex:
+    """
+    Inverted index for substring searches.
+
+    Every string is indexed by all of its substrings of length 1 to 3.
+    Queries of up to 3 characters are answered directly from the index.
+    For longer queries the posting lists of the query's trigrams are
+    intersected and the remaining candidates are checked with a substring test.
+
+    Results are ranked by where the query matched:
+    exact match, prefix, start of a word and anywhere else.
+    Shorter strings rank higher than longer ones with the same rank.
+    """
+    N = 3
+
+    def __init__(self, strings: Iterable[str]):
+        self.strings: list[str] = list(strings)
+        self._postings: dict[str, list[int]] = {}
+
+        for idx, s in enumerate(self.strings):
+            grams = set()
+            for n in range(1, self.N + 1):
+                for i in range(len(s) - n + 1):
+                    grams.add(s[i:i + n])
+
+            for gram in grams:
+                posting = self._postings.get(gram)
+                if posting is None:
+                    self._postings[gram] = [idx]
+                else:
+                    posting.append(idx)
+
+    def __len__(self):
+        return len(self.strings)
+
+    def _candidates(self, query: str) -> Iterable[int]:
+        if len(query) <= self.N:
+            return self._postings.get(query, ())
+
+        grams = {query[i:i + self.N] for i in range(len(query) - self.N + 1)}
+        postings = []
+        for gram in grams:
+            posting = self._postings.get(gram)
+            if posting is None:
+                return ()
+            postings.append(posting)
+
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for posting in postings[1:]:
+            candidates.intersection_update(posting)
+            if not candidates:
+                return ()
+
+        strings = self.strings
+        return [idx for idx in candidates if query in strings[idx]]
+
+    @staticmethod
+    def _rank(s: str, query: str) -> int:
+        if s == query:
+            return 0
+
+        if s.startswith(query):
+            return 1
+
+        pos = s.find(query)
+        if not s[pos - 1].isalnum():
+            return 2
+
+        return 3
+
+    def search(self, query: str, limit: Optional[int] = None) -> list[str]:
+        """
+        Find strings that contain the query
+
+        Args:
+            query: Substring to search for
+            limit: Maximum amount of results returned
+
+        Returns:
+            Matching strings ordered from the best match to the worst
+        """
+        if not query:
+            return []
+
+        strings = self.strings
+        rank = self._rank
+
+        def key(idx):
+            return rank(strings[idx], query), len(strings[idx]), idx
+
+        if limit is None:
+            matches = sorted(self._candidates(query), key=key)
+        else:
+            matches = heapq.nsmallest(limit, self._candidates(query), key=key)
+
+        return [strings[idx] for idx in matches]
@@ -49,6 +49,7 @@ from bot.exceptions import CommandBlacklisted, NotOwner
 from bot.globals import BlacklistTypes, PermValues
 from enums.data_enums import RedisKeyNamespaces
 from utils.imagetools import image_from_url
+from utils.scheduler import get_scheduler
 
 if TYPE_CHECKING:
     from bot.bot import Context
@@ -96,22 +97,6 @@ class DateAccuracy(Enum):
             return slice(self.value, other.value)
 
 
-class CallLater:
-    def __init__(self, future, runs_at):
-        self._future = future
-        self.runs_at = runs_at
-
-    @property
-    def future(self):
-        return self._future
-
-    def cancel(self):
-        self.future.cancel()
-
-    def __repr__(self):
-        return f'<{self.__class__.__name__}> Runs at {self.runs_at}'
-
-
 # Made so only ids can be used
 class Snowflake(abc.Snowflake):
     def __init__(self, id):
@@ -729,34 +714,18 @@ def sql2timedelta(value):
 
 def call_later(func, loop, timeout: float, *args, after=None, **kwargs):
     """
-    Call later for async functions
+    Call later for async functions.
+    Uses the shared scheduler of the loop so no task is created until the call is due
     Args:
         func: async function
         loop: asyncio loop
         timeout: how long to wait
-        after: Func to pass to future.add_done_callback
+        after: Func called with the ScheduledCall when it finishes or is cancelled
 
     Returns:
-        CallLater
+        ScheduledCall
     """
-    async def wait():
-        if timeout > 0:
-            try:
-                await asyncio.sleep(timeout)
-            except asyncio.CancelledError:
-                return
-
-        try:
-            await func(*args, **kwargs)
-        except:
-            logger.exception('Failed to call_later')
-            raise
-
-    fut = asyncio.run_coroutine_threadsafe(wait(), loop)
-    if callable(after):
-        fut.add_done_callback(after)
-
-    return CallLater(fut, utcnow() + timedelta(seconds=timeout))
+    return get_scheduler(loop).schedule(None, timeout, func, *args, after=after, **kwargs)
 
 
 def get_channel(channels, s, name_matching=False, only_text=True):
@@ -1255,9 +1224,7 @@ async def check_blacklist(ctx: Union[ApplicationCommandInteraction, 'Context']):
 
     command = ctx.application_command if isinstance(ctx, ApplicationCommandInteraction) else ctx.command
 
-    overwrite_perms = await bot.dbutil.check_blacklist(
-        "(command='%s' OR command IS NULL)" % command.name, ctx.author, ctx,
-        True)
+    overwrite_perms = bot.blacklist_cache.check_blacklist(command.name, ctx.author, ctx, True)
     msg, full_msg = PermValues.BLACKLIST_MESSAGES.get(overwrite_perms,
                                                       (None, None))
     if isinstance(overwrite_perms, int):